@@ -69,6 +69,24 @@ def mock_aws_api(method, path, req, config={}):
     # print(path)
     metric_name = req.form.get('MetricName') if req.form else None
     namespace = req.form.get('Namespace') if req.form else None
+    action = req.form.get('Action') if req.form else None
+    if action == 'GetMetricData':
+        results = ''
+        for i in range(1, 1000):
+            query_id = req.form.get('MetricDataQueries.member.%s.Id' % i)
+            if not query_id:
+                break
+            metric = req.form.get('MetricDataQueries.member.%s.MetricStat.Metric.MetricName' % i)
+            value = config.get('cloudwatch.%s.value' % metric) or 0
+            results += """<member><Id>%s</Id><StatusCode>Complete</StatusCode>
+                <Timestamps><member>%s</member></Timestamps><Values><member>%s</member></Values></member>
+                """ % (query_id, datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT), value)
+        result_str = """<GetMetricDataResponse xmlns="http://monitoring.amazonaws.com/doc/2010-08-01/">
+              <GetMetricDataResult>
+                <MetricDataResults>%s</MetricDataResults>
+              </GetMetricDataResult>
+            </GetMetricDataResponse>""" % results
+        return make_response(result_str)
     if path == 'aws/cloudwatch/get-metric-statistics' or (metric_name and namespace):
         action = req.form.get('Action')
         if action == 'GetMetricStatistics':
@@ -208,6 +226,9 @@ def mock_aws_api(method, path, req, config={}):
             "StreamDescription": {"Shards": shards}
         }
 
+    elif target == 'ElasticMapReduce.ModifyInstanceGroups':
+        config.setdefault('modify_instance_groups', []).append(json.loads(req.data))
+
     elif target == 'ElasticMapReduce.ListBootstrapActions':
         result = {}
         # TODO!
@@ -15,11 +15,15 @@ def serve(port):
             self.cpu = None
             self.mem = None
             self.sysload = None
+            # list of hosts returned for aggregate (cluster-wide) graph requests
+            self.hosts = []
             self.app = Flask('testapp')
 
         def run(self):
             @self.app.route('/ganglia/graph.php')
             def graph():
+                if request.args.get('aggregate'):
+                    return mock_ganglia_aggregate(self.hosts, cpu=self.cpu, mem=self.mem, sysload=self.sysload)
                 graph_type = request.args.get('g')
                 cpu = self.cpu if graph_type == 'cpu_report' else None
                 mem = self.mem if graph_type == 'mem_report' else None
@@ -34,7 +38,24 @@ def serve(port):
     return app
 
 
+def mock_ganglia_aggregate(hosts, cpu=None, mem=None, sysload=None):
+    result = []
+    metric_names = {'cpu_idle': 'cpu_idle', 'bmem_total': 'bmem_total', 'bmem_free': 'bmem_free', 'a0': 'load_one'}
+    for host in hosts:
+        for curve in get_curves(cpu=cpu, mem=mem, sysload=sysload):
+            curve['host_name'] = host
+            curve['metric_name'] = metric_names[curve['ds_name']]
+            curve['ds_name'] = 'a%s' % len(result)
+            result.append(curve)
+    return make_response(json.dumps(result))
+
+
 def mock_ganglia(cpu=None, mem=None, sysload=None):
+    result = get_curves(cpu=cpu, mem=mem, sysload=sysload)
+    return make_response(json.dumps(result))
+
+
+def get_curves(cpu=None, mem=None, sysload=None):
     from themis.util import common
 
     result = []
@@ -79,4 +100,4 @@ def mock_ganglia(cpu=None, mem=None, sysload=None):
             sysload_dp.append([load_value, t])
         t += 15
 
-    return make_response(json.dumps(result))
+    return result
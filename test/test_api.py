@@ -40,3 +40,9 @@ def test_api_calls():
 
     response = requests.get('%s/kinesis/streams' % TEST_API_ENDPOINT)
     assert('results' in json.loads(response.text))
+
+
+def test_state_invalid_max_age():
+    response = requests.get('%s/emr/state/testCluster?max_age=abc' % TEST_API_ENDPOINT)
+    assert(response.status_code == 400)
+    assert('max_age' in json.loads(response.text)['error'])
@@ -0,0 +1,191 @@
+import time
+import json
+import decimal
+from datetime import datetime
+import subprocess32 as subprocess
+from themis.util import common
+from themis.util.exceptions import TaskTimeoutException
+
+
+def test_parallelize():
+    result = common.parallelize([1, 2, 3], lambda x: x * 2)
+    assert result == [2, 4, 6]
+
+    result = common.parallelize({'a': 1}, lambda k, v: '%s%s' % (k, v))
+    assert result == ['a1']
+
+    # nested fan-outs must not dead-lock, even with a single worker thread
+    pool = common.get_worker_pool()
+    max_workers = pool.max_workers
+    pool.set_max_workers(1)
+    try:
+        result = common.parallelize([1, 2], lambda x: sum(common.parallelize([x, x], lambda y: y)))
+        assert result == [2, 4]
+    finally:
+        pool.set_max_workers(max_workers)
+
+
+def test_parallelize_errors():
+    def func(x):
+        if x == 2:
+            raise Exception('test error')
+        time.sleep(0.3 if x == 3 else 0)
+        return x
+
+    # errors are not propagated by default
+    assert common.parallelize([1, 2], func) == [1, None]
+
+    try:
+        common.parallelize([1, 2], func, raise_errors=True)
+        assert False
+    except Exception, e:
+        assert 'test error' in str(e)
+
+    try:
+        common.parallelize([1, 3], func, timeout=0.1, raise_errors=True)
+        assert False
+    except TaskTimeoutException, e:
+        pass
+    assert common.get_worker_pool().get_stats()['timeouts'] > 0
+
+
+def test_run_cached():
+    calls = []
+
+    def get_value(value):
+        calls.append(value)
+        return {'value': value}
+
+    result = common.run_func(get_value, value=1, cache_duration_secs=60)
+    assert common.run_func(get_value, value=1, cache_duration_secs=60) is result
+    assert common.run_func(get_value, value=2, cache_duration_secs=60) == {'value': 2}
+    assert calls == [1, 2]
+    # results older than the given cache duration are not used
+    common.run_func(get_value, value=1, cache_duration_secs=0.000001)
+    assert calls == [1, 2, 1]
+
+
+def test_ttl_cache():
+    import shutil
+    import tempfile
+    from themis.util.cache import TTLCache
+
+    cache = TTLCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a', 60) == (True, 1)
+    # least recently used entry is evicted
+    cache.put('c', 3)
+    assert cache.get('b', 60) == (False, None)
+    assert cache.get('a', 60) == (True, 1)
+    stats = cache.get_stats()
+    assert stats['evictions'] == 1 and stats['entries'] == 2 and stats['misses'] == 1
+
+    # least recently used entries are evicted once the size of all entries exceeds max_bytes
+    cache = TTLCache(max_entries=100, max_bytes=100)
+    cache.put('a', 'x' * 40)
+    cache.put('b', 'x' * 40)
+    cache.put('c', 'x' * 40)
+    assert cache.get('a', 60) == (False, None)
+    assert cache.get('c', 60) == (True, 'x' * 40)
+    assert cache.get_stats()['bytes'] <= 100
+    # values larger than max_bytes are not kept in memory
+    cache.put('d', 'x' * 200)
+    assert cache.get('d', 60) == (False, None)
+    assert cache.get('c', 60) == (True, 'x' * 40)
+    assert cache.get_stats()['too_large'] == 1
+
+    # entries are restored from the on-disk tier
+    disk_dir = tempfile.mkdtemp()
+    try:
+        cache = TTLCache(disk_dir=disk_dir)
+        cache.put('key', {'list': [1, 2]})
+        # values which cannot be encoded as JSON are only kept in memory
+        cache.put('time', {'time': datetime(2017, 1, 2, 3, 4, 5)})
+        cache = TTLCache(disk_dir=disk_dir)
+        assert cache.get('key', 60) == (True, {'list': [1, 2]})
+        assert cache.get('time', 60) == (False, None)
+        assert cache.get_stats()['disk_hits'] == 1
+    finally:
+        shutil.rmtree(disk_dir)
+
+
+def test_run_cached_single_flight():
+    import threading
+    calls = []
+
+    def get_value(value):
+        calls.append(value)
+        time.sleep(0.3)
+        if value == 'error':
+            raise Exception('test error')
+        return value
+
+    results = []
+    errors = []
+
+    def run(value):
+        try:
+            results.append(common.run_func(get_value, value=value, cache_duration_secs=60))
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(v, )) for v in ['sf-%s' % time.time()] * 5 + ['error'] * 3]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 2
+    assert len(results) == 5 and len(set(results)) == 1
+    assert len(errors) == 3 and len(set(errors)) == 1
+    assert common.get_cache().get_stats()['coalesced'] >= 6
+
+
+def test_run():
+    assert common.run('echo test') == 'test\n'
+    # large outputs
+    assert len(common.run('head -c 1000000 /dev/zero')) == 1000000
+
+    # commands are killed on timeout
+    start = time.time()
+    try:
+        common.run('sleep 10', timeout=0.5)
+        assert False
+    except subprocess.TimeoutExpired, e:
+        pass
+    assert time.time() - start < 5
+
+    # failed commands are retried
+    try:
+        common.run('echo test; exit 2', retries=2, sleep=0.01)
+        assert False
+    except subprocess.CalledProcessError, e:
+        assert e.returncode == 2
+        assert e.output == 'test\n'
+
+
+def test_json_encode_NaN():
+    nan = float('NaN')
+    data = {'a': [1, nan, 'NaN', {'b': nan, 'c': 2.5}], 'd': float('Inf'), 'e': decimal.Decimal('1.5'),
+            'f': datetime(2017, 1, 2, 3, 4, 5), 5: [nan], 'g': None}
+    result = json.loads(common.json_dumps(data))
+    assert result == {'a': [1, {'c': 2.5}], 'e': 1.5, 'f': '2017-01-02T03:04:05.000000Z', '5': [], 'g': None}
+    # the given object is not modified
+    assert len(data['a']) == 4 and 'b' in data['a'][3] and 'd' in data
+    result = json.loads(common.json_dumps(data, delete_values=False, replacement=0))
+    assert result['a'] == [1, 0, 0, {'b': 0, 'c': 2.5}]
+    assert result['d'] == 0
+    # the encoded data is consistent with remove_NaN(..)
+    data = {'a': [1, nan, [nan, 2]], 'b': {'c': nan}}
+    assert json.loads(common.json_dumps(data)) == common.remove_NaN(data)
+
+
+def test_json_encode_keys():
+    data = {5: 1, 2.5: 2, True: 3, None: 4, decimal.Decimal('1.5'): 5, decimal.Decimal('2'): 6,
+            datetime(2017, 1, 2, 3, 4, 5): 7, 'a': 8}
+    result = json.loads(common.json_dumps(data))
+    assert result == {'5': 1, '2.5': 2, 'true': 3, 'null': 4, '1.5': 5, '2': 6,
+                      '2017-01-02T03:04:05.000000Z': 7, 'a': 8}
+    # keys are encoded like json.dumps(..) does (except for booleans, which Python 2 encodes as "True"/"False")
+    data = {5: 1, 2.5: 2, None: 4, float('Inf'): 5}
+    assert json.loads(common.json_dumps(data)) == json.loads(json.dumps(data))
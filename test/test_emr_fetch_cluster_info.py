@@ -1,7 +1,8 @@
 import os
 import json
+import time
 from constants import *
-from themis.util import common, aws_common
+from themis.util import common, aws_common, remote
 import mock.aws_api
 
 
@@ -29,3 +30,313 @@ def test_aws_cli():
 
     out = emr_client.list_clusters()
     assert out['Clusters'][0]['Id'] == 'testClusterID1'
+
+
+def test_add_stats():
+    from themis.monitoring import emr_monitoring
+
+    nodes_list = [
+        {'host': 'h1', 'type': 'MASTER', 'state': 'RUNNING', 'queries': 0,
+            'load': {'cpu': 0.1, 'mem': 0.5, 'sysload': 1.0}},
+        {'host': 'h2', 'type': 'TASK', 'market': 'SPOT', 'state': 'RUNNING', 'queries': 2, 'presto_state': 'ACTIVE',
+            'load': {'cpu': 0.4, 'mem': 0.2, 'sysload': 3.0}},
+        {'host': 'h3', 'type': 'TASK', 'state': 'RUNNING', 'queries': 4, 'presto_state': 'ACTIVE',
+            'load': {'cpu': 0.8, 'mem': float('NaN')}}
+    ]
+    data = {'nodes_list': nodes_list}
+    emr_monitoring.add_stats(data)
+
+    tasknodes = data['tasknodes']
+    assert tasknodes['count']['nodes'] == 2
+    assert tasknodes['running'] and tasknodes['active']
+    assert abs(tasknodes['average']['cpu'] - 0.6) < 0.0001
+    assert abs(tasknodes['sum']['cpu'] - 1.2) < 0.0001
+    assert tasknodes['min']['cpu'] == 0.4 and tasknodes['max']['cpu'] == 0.8
+    # missing values count as zero for all statistics except min/max
+    assert tasknodes['average']['mem'] == 0.1
+    assert abs(tasknodes['p50']['mem'] - 0.1) < 0.0001
+    assert abs(tasknodes['stddev']['mem'] - 0.1) < 0.0001
+    assert tasknodes['min']['mem'] == 0.2
+    assert abs(tasknodes['stddev']['cpu'] - 0.2) < 0.0001
+    assert tasknodes['sum']['queries'] == 6 and tasknodes['average']['queries'] == 3
+
+    assert data['allnodes']['count']['nodes'] == 3
+    assert not data['allnodes']['active']
+    assert nodes_list[0]['presto_state'] == 'N/A'
+    assert data['masternodes']['p90']['cpu'] == 0.1
+
+    corenodes = data['corenodes']
+    assert corenodes['count']['nodes'] == 0
+    assert corenodes['running'] and corenodes['active']
+    assert corenodes['average']['cpu'] == 'NaN' and corenodes['p99']['cpu'] == 'NaN'
+    assert corenodes['sum']['queries'] == 0
+
+    table = emr_monitoring.NodeTable(nodes_list)
+    assert table.columns['market'].tolist() == [None, 'SPOT', None]
+
+
+def test_list_all_clusters():
+    import themis.model.resources_model
+    from themis.monitoring import emr_monitoring
+
+    clusters = emr_monitoring.list_all_clusters()
+    assert [c['Id'] for c in clusters] == ['testClusterID1']
+
+    master = emr_monitoring.get_master_node('testClusterID1')
+    assert master['PrivateDnsName'].startswith('testhost-')
+
+
+def test_init_emr_config_cluster_error():
+    from themis.monitoring import emr_monitoring
+
+    class MockEmrClient(object):
+        def describe_cluster(self, ClusterId):
+            if ClusterId == 'cluster2':
+                raise Exception('Throttling')
+            return {'Cluster': {'MasterPublicDnsName': '%s.public' % ClusterId,
+                'Applications': [{'Name': 'Presto-Sandbox'}]}}
+
+    clusters = [{'Id': 'cluster%s' % i, 'Name': 'Cluster %s' % i} for i in range(1, 5)]
+    list_all_clusters = emr_monitoring.list_all_clusters
+    get_master_node = emr_monitoring.get_master_node
+    connect_emr = aws_common.connect_emr
+    emr_monitoring.list_all_clusters = lambda role=None: clusters
+    emr_monitoring.get_master_node = lambda cluster_id, role=None: {'PrivateDnsName': '%s.private' % cluster_id}
+    aws_common.connect_emr = lambda role=None: MockEmrClient()
+    try:
+        # a failure for one cluster does not drop the other clusters
+        for run_parallel in [True, False]:
+            cfg = emr_monitoring.init_emr_config(run_parallel=run_parallel)
+            assert [c.id for c in cfg.emr] == ['cluster1', 'cluster3', 'cluster4']
+            assert [c.ip for c in cfg.emr] == ['cluster1.private', 'cluster3.private', 'cluster4.private']
+            assert cfg.emr[0].type == 'Presto'
+    finally:
+        emr_monitoring.list_all_clusters = list_all_clusters
+        emr_monitoring.get_master_node = get_master_node
+        aws_common.connect_emr = connect_emr
+
+
+def test_cloudwatch_metrics():
+    import themis.model.resources_model
+    from themis.model.emr_model import EmrCluster
+    from themis.monitoring import emr_cloudwatch
+
+    mock.aws_api.server.config['cloudwatch.CPUUtilization.value'] = 40
+    mock.aws_api.server.config['cloudwatch.YARNMemoryAvailablePercentage.value'] = 25
+    mock.aws_api.server.config['cloudwatch.ContainerPending.value'] = 3
+    cluster = EmrCluster('testClusterID1')
+    nodes = [{'host': 'testhost-%s' % i, 'iid': 'i-%s' % i} for i in range(0, 3)]
+    try:
+        metrics = emr_cloudwatch.get_cluster_metrics(cluster, nodes, 600)
+    finally:
+        for metric in ('CPUUtilization', 'YARNMemoryAvailablePercentage', 'ContainerPending'):
+            del mock.aws_api.server.config['cloudwatch.%s.value' % metric]
+
+    assert metrics['yarn']['containers_pending'] == 3
+    assert set(metrics['nodes'].keys()) == set(n['host'] for n in nodes)
+    for host, load in metrics['nodes'].iteritems():
+        assert abs(load['cpu'] - 0.4) < 0.0001
+        assert abs(load['mem'] - 0.75) < 0.0001
+
+
+def test_cloudwatch_metric_data_batches():
+    import math
+    from themis.monitoring import emr_cloudwatch
+
+    requests = []
+
+    class MockCloudWatchClient(object):
+        def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+            requests.append(([q['Id'] for q in MetricDataQueries], NextToken))
+            # return the results of each batch in two pages, and no data for query "q0"
+            page = MetricDataQueries[:2] if not NextToken else MetricDataQueries[2:]
+            results = [{'Id': q['Id'], 'Values': [] if q['Id'] == 'q0' else [10.0, 20.0]} for q in page]
+            if NextToken and MetricDataQueries[1]['Id'] == 'q1':
+                # the values of query "q1" continue on the second page
+                results.append({'Id': 'q1', 'Values': [60.0]})
+            return {'MetricDataResults': results, 'NextToken': None if NextToken else 'page2'}
+
+    queries = [emr_cloudwatch.get_metric_query('q%s' % i, 'AWS/EC2', 'CPUUtilization',
+        {'InstanceId': 'i-%s' % i}, 60) for i in range(0, emr_cloudwatch.CW_MAX_QUERIES_PER_REQUEST + 5)]
+    connect_cloudwatch = aws_common.connect_cloudwatch
+    aws_common.connect_cloudwatch = lambda role=None: MockCloudWatchClient()
+    try:
+        values = emr_cloudwatch.get_metric_values(queries, 600)
+    finally:
+        aws_common.connect_cloudwatch = connect_cloudwatch
+
+    # one request per page of each batch of CW_MAX_QUERIES_PER_REQUEST queries
+    assert [(len(ids), token) for ids, token in requests] == [(100, None), (100, 'page2'), (5, None), (5, 'page2')]
+    assert requests[2][0] == ['q%s' % i for i in range(100, 105)]
+    assert set(values.keys()) == set(q['Id'] for q in queries)
+    assert math.isnan(values['q0'])
+    assert values['q1'] == 30.0
+    assert all(values[key] == 15.0 for key in values if key not in ['q0', 'q1'])
+
+
+def test_client_cache():
+    import boto3
+
+    class MockSession(aws_common.StsSession):
+        def get(self):
+            return self.session
+
+    stats = aws_common.get_client_cache_stats()
+    client = aws_common.connect_emr()
+    assert aws_common.connect_emr() is client
+    assert aws_common.connect_kinesis() is not client
+    assert aws_common.get_client_cache_stats()['hits'] > stats['hits']
+
+    # clients are re-created if the session of a role is renewed
+    session = MockSession('testRole')
+    session.session = boto3.session.Session(region_name='us-east-1')
+    client = aws_common.connect_emr(session=session)
+    assert aws_common.connect_emr(session=session) is client
+    session.session = boto3.session.Session(region_name='us-east-1')
+    assert aws_common.connect_emr(session=session) is not client
+    assert aws_common.get_client_cache_stats()['invalidations'] > stats['invalidations']
+
+
+def test_instance_group_index():
+    mock.aws_api.server.config['group_id_task_spot'] = 'group_task_spot'
+    mock.aws_api.server.config['group_id_task_od'] = 'group_task_od'
+
+    index = aws_common.get_instance_group_index('testClusterID1', refresh=True)
+    assert aws_common.get_instance_group_index('testClusterID1') is index
+    assert index.get('group_task_spot')['Market'] == 'SPOT'
+    assert index.get('group_task_od')['type'] == aws_common.INSTANCE_GROUP_TYPE_TASK
+    assert index.get('unknown_group') is None
+    assert len(index.get_groups(aws_common.INSTANCE_GROUP_TYPE_TASK)) == 2
+
+
+def test_credential_manager():
+    class MockSession(object):
+        def __init__(self, expires_in):
+            self.expires_at = time.time() + expires_in
+
+    sessions = {'role1': [MockSession(3600), MockSession(3600)], 'role2': [MockSession(30), MockSession(3600)]}
+
+    def assume_role(role_arn):
+        if not sessions[role_arn]:
+            raise Exception('Access denied')
+        return sessions[role_arn].pop(0)
+
+    manager = aws_common.CredentialManager()
+    manager.sessions = {}
+    manager.start = lambda: None
+    do_assume_role = aws_common.do_assume_role
+    aws_common.do_assume_role = assume_role
+    try:
+        # valid sessions are handed out from the cache
+        session = manager.get_session('role1')
+        assert manager.get_session('role1') is session
+        # sessions which are about to expire are renewed inline
+        session = manager.get_session('role2')
+        assert manager.get_session('role2') is not session
+        # sessions which expire within the renewal period are renewed in the background
+        manager.sessions['role1'].expires_at = time.time() + aws_common.SESSION_EXPIRY_RENEW_PERIOD - 10
+        session = manager.get_session('role1')
+        manager.refresh_all()
+        assert manager.get_session('role1') is not session
+        # failed renewals are counted, and the previous session is kept
+        manager.sessions['role2'].expires_at = time.time() + aws_common.SESSION_EXPIRY_RENEW_PERIOD - 10
+        session = manager.get_session('role2')
+        manager.refresh_all()
+        assert manager.get_session('role2') is session
+    finally:
+        aws_common.do_assume_role = do_assume_role
+    stats = manager.get_stats()
+    assert stats['refreshes'] == 4
+    assert stats['failures'] == 1
+    assert set(stats['sessions'].keys()) == set(['role1', 'role2'])
+
+
+def test_presto_node_states_from_coordinator():
+    from themis.model.emr_model import EmrCluster
+    from themis.monitoring import emr_monitoring
+
+    cluster = EmrCluster(id='testPrestoStatesCluster')
+    cluster.ip = 'ip-10-0-0-1.ec2.internal'
+    rows = [['http://10.0.0.2:8889', 'active'], ['http://10.0.0.3:8889', 'shutting_down']]
+    running = aws_common.INSTANCE_STATE_RUNNING
+    nodes = dict(('ip-10-0-0-%s.ec2.internal' % i, {'state': running}) for i in range(2, 5))
+    nodes['ip-10-0-0-5.ec2.internal'] = {'state': aws_common.INSTANCE_STATE_TERMINATED}
+    queried = []
+
+    def get_node_states(cluster_ip, hosts):
+        queried.extend(hosts)
+        return dict((host, 'ACTIVE') for host in hosts)
+
+    run_coordinator_query = emr_monitoring.run_coordinator_query
+    get_presto_node_states = aws_common.get_presto_node_states
+    emr_monitoring.run_coordinator_query = lambda cluster, sql: rows
+    aws_common.get_presto_node_states = get_node_states
+    try:
+        emr_monitoring.get_presto_node_states(nodes, cluster)
+        states = dict((host, node['presto_state']) for host, node in nodes.iteritems())
+        assert states == {'ip-10-0-0-2.ec2.internal': 'ACTIVE', 'ip-10-0-0-3.ec2.internal': 'SHUTTING_DOWN',
+                          'ip-10-0-0-4.ec2.internal': 'N/A', 'ip-10-0-0-5.ec2.internal': 'N/A'}
+        assert not queried
+
+        # fall back to querying the running nodes if the coordinator is not available
+        def fail(cluster, sql):
+            raise Exception('Coordinator not available')
+        emr_monitoring.run_coordinator_query = fail
+        emr_monitoring.get_presto_node_states(nodes, cluster)
+        assert sorted(queried) == sorted(['ip-10-0-0-%s.ec2.internal' % i for i in range(2, 5)])
+        assert nodes['ip-10-0-0-4.ec2.internal']['presto_state'] == 'ACTIVE'
+        assert nodes['ip-10-0-0-5.ec2.internal']['presto_state'] == 'N/A'
+    finally:
+        emr_monitoring.run_coordinator_query = run_coordinator_query
+        aws_common.get_presto_node_states = get_presto_node_states
+
+
+def test_run_coordinator_query():
+    from themis.model.emr_model import EmrCluster
+    from themis.monitoring import emr_monitoring
+
+    class MockCursor(object):
+        def execute(self, sql):
+            if connection_error:
+                raise Exception('Connection refused')
+            self.sql = sql
+
+        def fetchall(self):
+            return [['http://10.0.0.2:8889', 'direct']]
+
+    class MockConnection(object):
+        def cursor(self):
+            return MockCursor()
+
+    ssh_calls = []
+
+    def run_ssh(cmd, host, **kwargs):
+        ssh_calls.append(cmd)
+        return 'Warning: Permanently added ...\n"http://10.0.0.2:8889","ssh"\n'
+
+    cluster = EmrCluster(id='testCoordinatorCluster')
+    cluster.ip = 'ip-10-0-0-%s.ec2.internal' % common.short_uid()
+    connection_error = False
+    get_presto_connection = common.get_presto_connection
+    common.get_presto_connection = lambda hostname, port: MockConnection()
+    emr_monitoring.run_ssh = run_ssh
+    try:
+        # the query is sent to the coordinator directly
+        assert emr_monitoring.run_coordinator_query(cluster, 'SELECT 1') == [['http://10.0.0.2:8889', 'direct']]
+        assert not ssh_calls
+
+        # if the coordinator is unreachable, the query is run via SSH
+        connection_error = True
+        assert emr_monitoring.run_coordinator_query(cluster, 'SELECT 2') == [['http://10.0.0.2:8889', 'ssh']]
+        assert len(ssh_calls) == 1
+
+        # direct connections are not retried within PRESTO_DIRECT_RETRY_SECS after a failure
+        connection_error = False
+        assert emr_monitoring.run_coordinator_query(cluster, 'SELECT 3') == [['http://10.0.0.2:8889', 'ssh']]
+        assert len(ssh_calls) == 2
+        emr_monitoring.PRESTO_DIRECT_FAILURES[cluster.ip] -= emr_monitoring.PRESTO_DIRECT_RETRY_SECS + 1
+        assert emr_monitoring.run_coordinator_query(cluster, 'SELECT 4') == [['http://10.0.0.2:8889', 'direct']]
+        assert cluster.ip not in emr_monitoring.PRESTO_DIRECT_FAILURES
+    finally:
+        common.get_presto_connection = get_presto_connection
+        emr_monitoring.run_ssh = remote.run_ssh
@@ -1,3 +1,5 @@
+import time
+import numpy
 from datetime import datetime
 from themis import config
 from themis.scaling.emr_scaling import *
@@ -283,3 +285,144 @@ def test_downscale_preferred_market():
     assert_downscale_preferred_market('ON_DEMAND,SPOT', 4, 4, 2, 0, 2)
     assert_downscale_preferred_market('SPOT,ON_DEMAND', 4, 1, 1, 1, 2)
     assert_downscale_preferred_market('ON_DEMAND,SPOT', 1, 4, 1, 1, 2)
+
+
+def test_cluster_load_bulk():
+    server = get_server()
+    server.cpu = 90  # mock 90% CPU usage
+    server.mem = 50  # mock 50% memory usage
+    server.sysload = 2
+    hosts = ['testhost-%s' % common.short_uid() for i in range(0, 3)]
+    server.hosts = hosts
+    cache_timeout = emr_monitoring.GANGLIA_CACHE_TIMEOUT
+    emr_monitoring.GANGLIA_CACHE_TIMEOUT = 0
+
+    cluster = EmrCluster(id=TEST_CLUSTER_ID)
+    cluster.ip = 'localhost:%s' % GANGLIA_PORT
+    cluster.ip_public = 'localhost:%s' % GANGLIA_PORT
+    try:
+        loads = emr_monitoring.get_cluster_load_bulk(cluster)
+    finally:
+        emr_monitoring.GANGLIA_CACHE_TIMEOUT = cache_timeout
+        server.hosts = []
+        server.sysload = None
+
+    assert(set(loads.keys()) == set(hosts))
+    for host, load in loads.iteritems():
+        assert(abs(load['cpu'] - 0.9) < 0.001)
+        assert(abs(load['mem'] - 0.5) < 0.001)
+        assert(abs(load['sysload'] - 2) < 0.001)
+
+
+def test_ganglia_windows_per_interval():
+    cluster_id = 'testClusterWindows-%s' % common.short_uid()
+    host = 'ip-10-0-0-1.ec2.internal'
+    names = ['cpu_idle']
+    time_now = time.time()
+    datapoints = numpy.array([[50, t] for t in range(int(time_now) - 3600, int(time_now), 15)], dtype=float)
+
+    # the full interval is fetched initially, only the missing data afterwards
+    assert emr_monitoring.get_ganglia_fetch_secs(cluster_id, [host], names, 3600) == 3600
+    emr_monitoring.update_ganglia_windows(cluster_id, host, {'cpu_idle': datapoints}, names, 3600)
+    assert emr_monitoring.get_ganglia_fetch_secs(cluster_id, [host], names, 3600) < 120
+
+    # a shorter interval neither evicts the datapoints of the longer one, nor reuses its window
+    assert emr_monitoring.get_ganglia_fetch_secs(cluster_id, [host], names, 600) == 600
+    curves = emr_monitoring.update_ganglia_windows(cluster_id, host, {'cpu_idle': datapoints[-40:]}, names, 600)
+    assert curves['cpu_idle'][0, 1] >= time_now - 600
+    curves = emr_monitoring.update_ganglia_windows(cluster_id, host, {}, names, 3600)
+    assert curves['cpu_idle'][0, 1] < time_now - 3000
+    assert emr_monitoring.get_ganglia_fetch_secs(cluster_id, [host], names, 3600) < 120
+
+    emr_monitoring.evict_ganglia_windows(cluster_id, [])
+    assert emr_monitoring.get_ganglia_fetch_secs(cluster_id, [host], names, 3600) == 3600
+
+
+def test_ganglia_endpoint_affinity():
+    server = get_server()
+    server.cpu = 90
+    server.mem = 50
+    closed_port = 1
+
+    cluster = EmrCluster(id='testClusterGanglia-%s' % common.short_uid())
+    cluster.ip = 'localhost:%s' % closed_port
+    cluster.ip_public = 'localhost:%s' % GANGLIA_PORT
+    emr_monitoring.get_ganglia_datapoints(cluster, 'testhost', 'cpu', 600)
+    state = emr_monitoring.GANGLIA_ENDPOINTS[cluster.id]
+    assert state['address'] == cluster.ip_public
+    # the working address is tried first from now on
+    assert emr_monitoring.get_ganglia_endpoints(cluster) == [cluster.ip_public, cluster.ip]
+    state['probed'] = 0
+    assert emr_monitoring.get_ganglia_endpoints(cluster) == [cluster.ip, cluster.ip_public]
+
+    # requests are skipped while all addresses of a cluster are unreachable
+    cluster.ip_public = cluster.ip
+    try:
+        emr_monitoring.get_ganglia_datapoints(cluster, 'testhost', 'mem', 600)
+        assert False
+    except Exception, e:
+        assert not isinstance(e, ConnectivityException)
+    assert state['failures'] == 1 and state['down_until'] > common.now()
+    try:
+        emr_monitoring.get_ganglia_datapoints(cluster, 'testhost', 'mem', 600)
+        assert False
+    except ConnectivityException, e:
+        pass
+
+
+def test_terminate_nodes_batched():
+    config = get_test_cluster_config()
+    cluster = EmrCluster(id=TEST_CLUSTER_ID)
+    cluster.type = aws_common.CLUSTER_TYPE_HIVE
+    nodes = [{'iid': 'i-1', 'gid': 'group_task_spot', 'ip': '10.0.0.1'},
+             {'iid': 'i-2', 'gid': 'group_task_od', 'ip': '10.0.0.2'},
+             {'iid': 'i-3', 'gid': 'group_task_spot', 'ip': '10.0.0.3'}]
+    mock.aws_api.server.config['modify_instance_groups'] = []
+
+    terminate_nodes(cluster, nodes, config=config)
+
+    # expect one request per instance group
+    requests = mock.aws_api.server.config['modify_instance_groups']
+    groups = dict((g['InstanceGroupId'], g['EC2InstanceIdsToTerminate'])
+                  for r in requests for g in r['InstanceGroups'])
+    assert len(requests) == 2
+    assert groups == {'group_task_spot': ['i-1', 'i-3'], 'group_task_od': ['i-2']}
+
+
+def test_presto_node_states_batched():
+    batches = []
+    responses = []
+
+    def run_ssh_batch(commands, host, **kwargs):
+        batches.append(commands)
+        return dict((key, responses.pop(0)(key)) for key in sorted(commands.keys()))
+
+    run_ssh_batch_orig = aws_common.run_ssh_batch
+    aws_common.run_ssh_batch = run_ssh_batch
+    try:
+        # states are queried from all nodes in a single batch
+        responses.extend([lambda ip: {'code': 0, 'output': 'Warning: Permanently added ...\n"ACTIVE"'},
+                          lambda ip: {'code': 7, 'output': ''}])
+        states = aws_common.get_presto_node_states('10.0.0.1', ['10.0.0.2', '10.0.0.3'])
+        assert states == {'10.0.0.2': 'ACTIVE', '10.0.0.3': None}
+        assert len(batches) == 1
+        assert '10.0.0.3:8889' in batches[0]['10.0.0.3']
+
+        # only nodes whose config has been updated are sent the new state
+        del batches[:]
+        responses.extend([lambda ip: {'code': 0, 'output': ''}, lambda ip: {'code': 1, 'output': 'error'},
+                          lambda ip: {'code': 0, 'output': '"SHUTTING_DOWN"'}])
+        states = aws_common.set_presto_node_states('10.0.0.1', ['10.0.0.2', '10.0.0.3'], 'SHUTTING_DOWN')
+        assert states == {'10.0.0.2': 'SHUTTING_DOWN', '10.0.0.3': None}
+        assert batches[0]['10.0.0.3'][1] == '10.0.0.3'
+        assert batches[1].keys() == ['10.0.0.2']
+        assert 'PUT' in batches[1]['10.0.0.2']
+
+        # no state is sent if no config could be updated
+        del batches[:]
+        responses.append(lambda ip: {'code': 1, 'output': 'error'})
+        states = aws_common.set_presto_node_states('10.0.0.1', ['10.0.0.2'], 'SHUTTING_DOWN')
+        assert states == {'10.0.0.2': None}
+        assert len(batches) == 1
+    finally:
+        aws_common.run_ssh_batch = run_ssh_batch_orig
@@ -79,3 +79,28 @@ def test_perform_scaling():
     assert(state.action == 'UPSCALE(+1)')
     state_obj = json.loads(state.state)
     assert(state_obj['stream']['IncomingBytes']['average'] == 1000000)
+
+
+def test_init_kinesis_config_stream_error():
+
+    class MockKinesisClient(object):
+        def list_streams(self):
+            return {'StreamNames': ['stream%s' % i for i in range(1, 5)]}
+
+    def retrieve_stream_details(stream_name, role=None):
+        if stream_name == 'stream3':
+            raise Exception('Throttling')
+        return KinesisStream(id=stream_name)
+
+    connect_kinesis = aws_common.connect_kinesis
+    details = kinesis_monitoring.retrieve_stream_details
+    aws_common.connect_kinesis = lambda role=None: MockKinesisClient()
+    kinesis_monitoring.retrieve_stream_details = retrieve_stream_details
+    try:
+        # a failure for one stream does not drop the other streams, and the order is preserved
+        for run_parallel in [True, False]:
+            cfg = kinesis_monitoring.init_kinesis_config(run_parallel=run_parallel)
+            assert [s.id for s in cfg.kinesis] == ['stream1', 'stream2', 'stream4']
+    finally:
+        aws_common.connect_kinesis = connect_kinesis
+        kinesis_monitoring.retrieve_stream_details = details
@@ -1,3 +1,4 @@
+import numpy
 from themis.util import math_util
 
 
@@ -19,3 +20,14 @@ def test_utils():
     values = [1, 2, 3, 1, 4, -5]
     idx = math_util.max_index(values)
     assert idx == 4
+
+
+def test_integrate_curves():
+    times = [0, 15, 30, 45, 60]
+    curve1 = numpy.array([[10, t] for t in times], dtype=float)
+    curve2 = numpy.array([[t, t] for t in times], dtype=float)
+    curve3 = numpy.array([[1, t * 2] for t in times], dtype=float)
+    result = math_util.integrate_curves([curve1, curve2, curve3])
+    assert result[0] == 600
+    assert result[1] == 1800
+    assert result[2] == 120
@@ -0,0 +1,74 @@
+import time
+from themis.model.emr_model import EmrCluster
+from themis.monitoring import prefetcher, resources, snapshots
+
+
+class MockCluster(EmrCluster):
+    fetch_count = 0
+
+    def needs_scaling(self, params=None):
+        return True
+
+    def fetch_data(self):
+        MockCluster.fetch_count += 1
+        self.monitoring_data = {'count': MockCluster.fetch_count}
+        snapshots.publish('emr', self.id, self.monitoring_data)
+        return self.monitoring_data
+
+
+def test_prefetch_and_take_snapshots():
+    background = prefetcher.MonitoringPrefetcher()
+    cluster = MockCluster('testPrefetchCluster')
+    background.prefetch([cluster])
+    key = ('emr', cluster.id)
+    resources.FETCH_TASKS[key].get(10)
+    count = MockCluster.fetch_count
+
+    # not due yet, hence no new collection
+    background.prefetch([cluster])
+    assert resources.FETCH_TASKS[key].done.is_set()
+    assert MockCluster.fetch_count == count
+
+    # snapshots older than max_age are not used for scaling
+    snapshots.get_snapshot_store().get('emr', cluster.id).timestamp -= 100
+    ready, pending = background.take_snapshots([MockCluster(cluster.id)], max_age=60)
+    assert not ready and len(pending) == 1
+    ready, pending = background.take_snapshots([MockCluster(cluster.id)])
+    assert len(ready) == 1 and not pending
+    assert ready[0].monitoring_data == {'count': count}
+    # each snapshot is used for scaling only once
+    ready, pending = background.take_snapshots([MockCluster(cluster.id)])
+    assert not ready and len(pending) == 1
+
+
+def test_take_snapshots_waits_for_collection():
+    class SlowCluster(MockCluster):
+        def fetch_data(self):
+            time.sleep(0.3)
+            return MockCluster.fetch_data(self)
+
+    background = prefetcher.MonitoringPrefetcher()
+    cluster = SlowCluster('testPrefetchSlowCluster')
+    background.prefetch([cluster])
+    count = MockCluster.fetch_count
+    # the in-progress collection is awaited instead of collecting the data again
+    ready, pending = background.take_snapshots([SlowCluster(cluster.id)], timeout=5)
+    assert len(ready) == 1 and not pending
+    assert MockCluster.fetch_count == count + 1
+
+
+def test_fetch_all_timeout():
+    class SlowCluster(MockCluster):
+        def fetch_data(self):
+            time.sleep(0.5)
+            return MockCluster.fetch_data(self)
+
+    cluster = SlowCluster('testFetchTimeoutCluster')
+    count = MockCluster.fetch_count
+    assert resources.fetch_all([cluster], timeout=0.1) == []
+    # the previous collection is still running, hence the resource is skipped
+    assert resources.fetch_all([cluster], timeout=0.1) == []
+    time.sleep(0.6)
+    assert MockCluster.fetch_count == count + 1
+    assert resources.fetch_all([cluster], timeout=5) == [cluster]
+    assert MockCluster.fetch_count == count + 2
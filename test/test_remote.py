@@ -0,0 +1,74 @@
+import base64
+from themis.util import common, remote
+
+
+def test_ssh_connections():
+    connection = remote.get_connection('hadoop', 'master1', '/tmp/test.key', via_hosts=['node1'])
+    assert remote.get_connection('hadoop', 'master1', '/tmp/test.key', via_hosts=['node1']) is connection
+    assert connection.get_id() == ('hadoop', '/tmp/test.key', ('master1', 'node1'))
+    # commands to the node are tunnelled through the connection to the master
+    master = remote.get_connection('hadoop', 'master1', '/tmp/test.key')
+    assert connection.jump is master
+    assert master.socket in connection.get_options()
+    assert master.socket != connection.socket
+
+    # idle connections are evicted
+    master.last_used = common.now() - remote.SSH_IDLE_TIMEOUT_SECS - 1
+    evicted = remote.evict_idle_connections()
+    assert evicted == [master]
+    assert remote.get_connection('hadoop', 'master1', '/tmp/test.key') is not master
+
+
+def test_ssh_key_resolver():
+    resolver = remote.SshKeyResolver()
+    keys = ['key1', 'key2', 'key3']
+    assert resolver.get_keys(['master1', 'node1'], keys) == keys
+
+    resolver.report(['master1'], 'key1', False)
+    resolver.report(['master1'], 'key2', True)
+    # the accepted key is tried first, also for nodes behind the same master
+    assert resolver.get_keys(['master1'], keys) == ['key2', 'key1', 'key3']
+    assert resolver.get_keys(['master1', 'node1'], keys) == ['key2', 'key1', 'key3']
+    resolver.report(['master1', 'node1'], 'key2', False)
+    resolver.report(['master1', 'node1'], 'key3', True)
+    assert resolver.get_keys(['master1', 'node1'], keys) == ['key3', 'key1', 'key2']
+
+    stats = resolver.get_stats()['keys']
+    assert stats['key1'] == {'success': 0, 'failure': 1, 'success_rate': 0}
+    assert stats['key2']['success_rate'] == 0.5
+
+
+def test_batch_script():
+    commands = ['echo test1', 'echo test2 >&2; exit 3', 'true']
+    script = remote.get_batch_script([(cmd, None) for cmd in commands], parallelism=2)
+    out = common.run('echo %s | base64 -d | sh' % base64.b64encode(script))
+    result = remote.parse_batch_output('Warning: Permanently added ...\n' + out)
+    assert result[0] == {'code': 0, 'output': 'test1\n'}
+    assert result[1] == {'code': 3, 'output': 'test2\n'}
+    assert result[2] == {'code': 0, 'output': ''}
+
+    # a missing exit code (e.g., a killed command) is reported as None, without losing the output
+    script = remote.get_batch_script([('echo test1', None), ('echo test2', None)])
+    script = script.replace('echo $? > $d/1.rc', 'true')
+    result = remote.parse_batch_output(common.run('echo %s | base64 -d | sh' % base64.b64encode(script)))
+    assert result[0] == {'code': 0, 'output': 'test1\n'}
+    assert result[1] == {'code': None, 'output': 'test2\n'}
+
+
+def test_batch_agent_forwarding():
+    calls = []
+
+    def run_ssh(cmd, host, **kwargs):
+        calls.append(kwargs['forward_agent'])
+        return ''
+
+    run_ssh_orig = remote.run_ssh
+    remote.run_ssh = run_ssh
+    try:
+        # the agent is only forwarded for batches with commands for other hosts
+        result = remote.run_ssh_batch({'a': 'echo test'}, 'master')
+        remote.run_ssh_batch({'a': 'echo test', 'b': ('echo test', 'node1')}, 'master')
+    finally:
+        remote.run_ssh = run_ssh_orig
+    assert calls == [False, True]
+    assert result == {'a': {'code': None, 'output': ''}}
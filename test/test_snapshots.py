@@ -0,0 +1,51 @@
+import threading
+from themis.monitoring import snapshots
+
+
+def test_snapshot_store():
+    store = snapshots.SnapshotStore()
+    assert store.get('emr', 'c1') is None
+
+    data = {'nodes': {'h1': {'load': {'cpu': 0.5}}}}
+    snapshot = store.publish('emr', 'c1', data)
+    assert snapshot.version == 1
+    # snapshots are decoupled from later modifications of the published data
+    data['nodes'] = {}
+    assert store.get('emr', 'c1').data['nodes']['h1']['load']['cpu'] == 0.5
+    assert store.publish('emr', 'c1', data).version == 2
+
+    # snapshots older than max_age are not returned
+    store.publish('emr', 'c2', {'a': 1}, timestamp=0)
+    assert store.get('emr', 'c2') is not None
+    assert store.get('emr', 'c2', max_age=60) is None
+
+
+def test_get_or_collect():
+    store = snapshots.SnapshotStore()
+    calls = []
+
+    def collect():
+        calls.append(1)
+        return {'value': len(calls)}
+
+    threads = [threading.Thread(target=store.get_or_collect, args=('kinesis', 's1', collect, 60))
+        for i in range(0, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert store.get_or_collect('kinesis', 's1', collect, max_age=60).data == {'value': 1}
+    assert store.get_or_collect('kinesis', 's1', collect, max_age=-1).data == {'value': 2}
+
+
+def test_remove_stale_snapshots():
+    from themis.model.emr_model import EmrCluster
+    from themis.monitoring import resources
+
+    store = snapshots.get_snapshot_store()
+    store.publish('emr', 'testStaleCluster1', {'a': 1})
+    store.publish('emr', 'testStaleCluster2', {'a': 2})
+    resources.remove_stale_snapshots([EmrCluster('testStaleCluster1')])
+    assert store.get('emr', 'testStaleCluster1')
+    assert not store.get('emr', 'testStaleCluster2')
@@ -31,3 +31,16 @@ def test_fillup_with_zeros():
     timestamps = [i['Timestamp'] for i in datapoints]
     for i in range(0, 60):
         assert ('2016-01-01T04:%s:00Z' % (('0' if i < 10 else '') + str(i))) in timestamps
+
+
+def test_rolling_window():
+    import numpy
+    window = timeseries.RollingWindow(60)
+    assert window.last_timestamp() is None
+    window.update(numpy.array([[1, 100], [2, 115], [3, 130]], dtype=float), now=140)
+    assert window.last_timestamp() == 130
+    # newer datapoints replace the buffered datapoints of the same time range
+    window.update(numpy.array([[5, 130], [6, 145], [7, 160]], dtype=float), now=170)
+    assert window.datapoints[:, 0].tolist() == [2, 5, 6, 7]
+    window.update(numpy.empty((0, 2)), now=200)
+    assert window.datapoints[:, 1].tolist() == [145, 160]
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, jsonify, send_from_directory, request
+from flask import Flask, Response, render_template, jsonify, send_from_directory, request
 from flask_swagger import swagger
 import os
 import re
@@ -10,10 +10,10 @@ import themis
 from themis import config, server
 from themis.config import *
 from themis.constants import *
-from themis.util import common, aws_common, aws_pricing
+from themis.util import common, aws_common, aws_pricing, remote
 from themis.util.aws_common import INSTANCE_GROUP_TYPE_TASK
 from themis.scaling import emr_scaling
-from themis.monitoring import resources, emr_monitoring, kinesis_monitoring, database
+from themis.monitoring import resources, emr_monitoring, kinesis_monitoring, database, snapshots
 
 root_path = os.path.dirname(os.path.realpath(__file__))
 web_dir = root_path + '/web/'
@@ -51,6 +51,11 @@ def healthcheck():
             result[key] = common.run(cmd)
         except Exception, e:
             result[key] = str(e)
+    result['worker_pool'] = common.get_worker_pool().get_stats()
+    result['aws_clients'] = aws_common.get_client_cache_stats()
+    result['credentials'] = aws_common.get_credential_manager().get_stats()
+    result['ssh_keys'] = remote.get_key_resolver().get_stats()
+    result['cache'] = common.get_cache().get_stats()
     return jsonify(result)
 
 
@@ -135,6 +140,27 @@ def do_set_config(section, new_config, resource=None):
     return jsonify({'config': cfg})
 
 
+def json_response(delete_values=True, replacement='NaN', **kwargs):
+    """ Return a JSON response with the given content, with NaN values deleted or replaced """
+    content = common.json_dumps(kwargs, delete_values=delete_values, replacement=replacement)
+    return Response(content, mimetype='application/json')
+
+
+def get_state_response(section, resource_id, collect_func):
+    """ Return the monitoring data snapshot of a resource, collecting fresh data if it exceeds the max. age """
+    max_age = request.args.get('max_age')
+    if max_age is None:
+        max_age = config.get_value(KEY_STATE_MAX_AGE, default=STATE_MAX_AGE_SECS)
+    elif not common.is_number(max_age) or common.is_NaN(float(max_age)) or float(max_age) < 0:
+        return jsonify({'error': 'Invalid value for parameter max_age: %s' % max_age}), 400
+    store = snapshots.get_snapshot_store()
+    snapshot = store.get_or_collect(section, resource_id, collect_func, max_age=float(max_age))
+    response = jsonify(snapshot.data)
+    response.headers['X-Snapshot-Version'] = str(snapshot.version)
+    response.headers['X-Snapshot-Age'] = str(int(snapshot.age()))
+    return response
+
+
 # ----------------------------------------
 # EMR specific APIs, prefixed with /emr/
 # ----------------------------------------
@@ -148,12 +174,16 @@ def get_emr_state(cluster_id):
         parameters:
             - name: cluster_id
               in: path
+            - name: max_age
+              in: query
     """
-    app_config = config.get_config()
-    cluster = resources.get_resource(SECTION_EMR, cluster_id)
-    monitoring_interval_secs = int(app_config.general.monitoring_time_window)
-    info = emr_monitoring.collect_info(cluster, monitoring_interval_secs=monitoring_interval_secs)
-    return jsonify(info)
+    def collect():
+        app_config = config.get_config()
+        cluster = resources.get_resource(SECTION_EMR, cluster_id)
+        monitoring_interval_secs = int(app_config.general.monitoring_time_window)
+        return emr_monitoring.collect_info(cluster, monitoring_interval_secs=monitoring_interval_secs)
+
+    return get_state_response(SECTION_EMR, cluster_id, collect)
 
 
 @app.route('/emr/history/<cluster_id>')
@@ -166,8 +196,7 @@ def get_emr_history(cluster_id):
               in: path
     """
     info = database.history_get(section=SECTION_EMR, resource=cluster_id, limit=100)
-    common.remove_NaN(info)
-    return jsonify(results=info)
+    return json_response(results=info)
 
 
 @app.route('/emr/clusters')
@@ -221,10 +250,10 @@ def get_emr_costs():
         config.get_value(KEY_BASELINE_COMPARISON_NODES, section=SECTION_EMR, resource=cluster_id, default=20))
     baseline_nodes = int(baseline_nodes)
     info = database.history_get(section=SECTION_EMR, resource=cluster_id, limit=num_datapoints)
+    # older history entries may still contain NaN values
     common.remove_NaN(info)
     result = aws_pricing.get_cluster_savings(info, baseline_nodes)
-    common.remove_NaN(result, delete_values=False, replacement=0)
-    return jsonify(results=result, baseline_nodes=baseline_nodes)
+    return json_response(delete_values=False, replacement=0, results=result, baseline_nodes=baseline_nodes)
 
 
 # -----------------------------------------------
@@ -250,12 +279,16 @@ def get_kinesis_state(stream_id):
         parameters:
             - name: stream_id
               in: path
+            - name: max_age
+              in: query
     """
-    app_config = config.get_config()
-    stream = resources.get_resource(SECTION_KINESIS, stream_id, reload=True)
-    monitoring_interval_secs = int(app_config.general.monitoring_time_window)
-    info = kinesis_monitoring.collect_info(stream, monitoring_interval_secs=monitoring_interval_secs)
-    return jsonify(info)
+    def collect():
+        app_config = config.get_config()
+        stream = resources.get_resource(SECTION_KINESIS, stream_id, reload=True)
+        monitoring_interval_secs = int(app_config.general.monitoring_time_window)
+        return kinesis_monitoring.collect_info(stream, monitoring_interval_secs=monitoring_interval_secs)
+
+    return get_state_response(SECTION_KINESIS, stream_id, collect)
 
 
 @app.route('/kinesis/history/<stream_id>')
@@ -268,8 +301,7 @@ def get_kinesis_history(stream_id):
               in: path
     """
     info = database.history_get(section=SECTION_KINESIS, resource=stream_id, limit=100)
-    common.remove_NaN(info)
-    return jsonify(results=info)
+    return json_response(results=info)
 
 
 # ------------------------
@@ -11,10 +11,44 @@ KEY_BASELINE_COMPARISON_NODES = 'baseline_nodes'
 KEY_NOW = 'now'
 KEY_CUSTOM_DOMAIN_NAME = 'custom_domain_name'
 KEY_SEND_SHUTDOWN_SIGNAL = 'send_shutdown_signal'
+KEY_PRESTO_STATE_SOURCE = 'presto_state_source'
+KEY_WORKER_POOL_SIZE = 'worker_pool_size'
+KEY_MONITORING_TIMEOUT = 'monitoring_timeout'
+KEY_GANGLIA_FETCH_MODE = 'ganglia_fetch_mode'
+KEY_GANGLIA_CONNECT_TIMEOUT = 'ganglia_connect_timeout'
+KEY_GANGLIA_READ_TIMEOUT = 'ganglia_read_timeout'
+KEY_GANGLIA_BULK_FETCH = 'ganglia_bulk_fetch'
+KEY_GANGLIA_INCREMENTAL_FETCH = 'ganglia_incremental_fetch'
+KEY_STATE_MAX_AGE = 'state_max_age'
+KEY_MONITORING_PREFETCH = 'monitoring_prefetch'
+KEY_PREFETCH_INTERVAL = 'prefetch_interval'
+KEY_METRICS_SOURCE = 'metrics_source'
 
 # default time to sleep between loops
 LOOP_SLEEP_TIMEOUT_SECS = 3 * 60
 
+# default deadline for collecting the monitoring data of a single resource
+MONITORING_TIMEOUT_SECS = 2 * 60
+
+# default maximum age of monitoring data snapshots served via the API
+STATE_MAX_AGE_SECS = 60
+
+# default seconds between background collections of the monitoring data of a resource
+PREFETCH_INTERVAL_EMR_SECS = 2 * 60
+PREFETCH_INTERVAL_KINESIS_SECS = 60
+
+# modes for fetching Ganglia monitoring data
+GANGLIA_FETCH_MODE_HTTP = 'http'
+GANGLIA_FETCH_MODE_CURL = 'curl'
+
+# sources of the load metrics of EMR cluster nodes
+METRICS_SOURCE_GANGLIA = 'ganglia'
+METRICS_SOURCE_CLOUDWATCH = 'cloudwatch'
+
+# sources for reading the Presto state of cluster nodes
+PRESTO_STATE_SOURCE_COORDINATOR = 'coordinator'
+PRESTO_STATE_SOURCE_NODES = 'nodes'
+
 # instance market constants
 MARKET_ON_DEMAND = "ON_DEMAND"
 MARKET_SPOT = "SPOT"
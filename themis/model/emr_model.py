@@ -1,4 +1,5 @@
 import themis.monitoring.emr_monitoring
+import themis.monitoring.snapshots
 import themis.scaling.emr_scaling
 from themis.util import aws_common
 from themis import config
@@ -11,11 +12,14 @@ class EmrCluster(Scalable, Monitorable):
         self.type = None
         self.ip = None
         self.ip_public = None
+        self.has_ganglia = True
         self.monitoring_data = {}
 
     def fetch_data(self):
         if self.needs_scaling():
             self.monitoring_data = themis.monitoring.emr_monitoring.collect_info(self)
+            if self.monitoring_data:
+                themis.monitoring.snapshots.publish(config.SECTION_EMR, self.id, self.monitoring_data)
         return self.monitoring_data
 
     def needs_scaling(self, params=None):
@@ -1,5 +1,6 @@
 from themis.model.aws_model import *
 import themis.monitoring.kinesis_monitoring
+import themis.monitoring.snapshots
 import themis.scaling.kinesis_scaling
 from themis import config
 
@@ -14,6 +15,8 @@ class KinesisStream(Scalable, Monitorable):
     def fetch_data(self):
         if self.needs_scaling():
             self.monitoring_data = themis.monitoring.kinesis_monitoring.collect_info(self)
+            if self.monitoring_data:
+                themis.monitoring.snapshots.publish(config.SECTION_KINESIS, self.id, self.monitoring_data)
         return self.monitoring_data
 
     def needs_scaling(self, params=None):
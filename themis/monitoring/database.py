@@ -4,7 +4,7 @@ import time
 from sqlalchemy import Table, Column, Integer, String, Text, MetaData, ForeignKey, create_engine, select
 from sqlalchemy.sql import and_, or_, not_
 import themis.config
-from themis.util.common import inject_env_vars
+from themis.util.common import inject_env_vars, json_dumps
 
 # global DB connection
 DB_TABLE_HISTORY = 'states_history'
@@ -69,7 +69,8 @@ def get_db_connection(db_url=None):
 
 
 def history_add(section, resource, state, action):
-    state = json.dumps(state)
+    # NaN values are not valid JSON, remove them while encoding the state
+    state = json_dumps(state)
     ms = time.time() * 1000.0
     db_connection = get_db_connection()
     conn = db_connection.connect()
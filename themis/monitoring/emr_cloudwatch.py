@@ -0,0 +1,105 @@
+from themis.util import aws_common
+from themis.util.common import get_logger, get_start_and_end, parallelize
+
+# logger
+LOG = get_logger(__name__)
+
+# maximum number of metric queries per GetMetricData request
+CW_MAX_QUERIES_PER_REQUEST = 100
+
+# minimum period (seconds) of CloudWatch metric statistics
+CW_MIN_PERIOD = 60
+
+# EMR cluster-level metrics, mapped to the keys under which they are reported
+EMR_CLUSTER_METRICS = {
+    'YARNMemoryAvailablePercentage': 'memory_available',
+    'ContainerPending': 'containers_pending'
+}
+
+
+def get_metric_query(query_id, namespace, metric, dimensions, period):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': namespace,
+                'MetricName': metric,
+                'Dimensions': [{'Name': k, 'Value': v} for k, v in dimensions.iteritems()]
+            },
+            'Period': period,
+            'Stat': 'Average'
+        },
+        'ReturnData': True
+    }
+
+
+def get_metric_values(queries, time_window, role=None):
+    """
+    Get the average value of multiple CloudWatch metrics over the last time_window seconds.
+    Uses batched GetMetricData requests if supported by the client, or one GetMetricStatistics
+    request per metric otherwise. Returns a map of query IDs to values (NaN if no data).
+    """
+    cloudwatch_client = aws_common.connect_cloudwatch(role=role)
+    start_time, end_time = get_start_and_end(diff_secs=time_window, format=None)
+    result = dict((query['Id'], float('NaN')) for query in queries)
+    if hasattr(cloudwatch_client, 'get_metric_data'):
+        # the values of a query may be split across multiple pages, hence sum them up first
+        sums = {}
+        for i in range(0, len(queries), CW_MAX_QUERIES_PER_REQUEST):
+            batch = queries[i:i + CW_MAX_QUERIES_PER_REQUEST]
+            kwargs = {}
+            while True:
+                out = cloudwatch_client.get_metric_data(MetricDataQueries=batch,
+                    StartTime=start_time, EndTime=end_time, **kwargs)
+                for series in out['MetricDataResults']:
+                    total = sums.setdefault(series['Id'], [0.0, 0])
+                    total[0] += sum(series['Values'])
+                    total[1] += len(series['Values'])
+                if not out.get('NextToken'):
+                    break
+                kwargs['NextToken'] = out['NextToken']
+        for query_id, (total, count) in sums.iteritems():
+            if count:
+                result[query_id] = total / count
+        return result
+
+    def get_statistics(query):
+        stat = query['MetricStat']
+        out = cloudwatch_client.get_metric_statistics(Namespace=stat['Metric']['Namespace'],
+            MetricName=stat['Metric']['MetricName'], Dimensions=stat['Metric']['Dimensions'],
+            StartTime=start_time, EndTime=end_time, Period=stat['Period'], Statistics=[stat['Stat']])
+        values = [d[stat['Stat']] for d in out['Datapoints']]
+        if values:
+            result[query['Id']] = float(sum(values)) / len(values)
+
+    parallelize(queries, get_statistics)
+    return result
+
+
+def get_cluster_metrics(cluster, nodes, monitoring_interval_secs, role=None):
+    """
+    Get the load of all given nodes of a cluster from CloudWatch, as an alternative to Ganglia.
+    CPU usage is reported per EC2 instance, whereas memory usage is only available for the whole
+    cluster (YARN memory) and assigned to all nodes. The system load is not available.
+    """
+    period = max(CW_MIN_PERIOD, int(monitoring_interval_secs) // CW_MIN_PERIOD * CW_MIN_PERIOD)
+    queries = []
+    for i, node in enumerate(nodes):
+        queries.append(get_metric_query('cpu%s' % i, 'AWS/EC2', 'CPUUtilization',
+            {'InstanceId': node['iid']}, period))
+    for metric in EMR_CLUSTER_METRICS:
+        queries.append(get_metric_query(metric.lower(), 'AWS/ElasticMapReduce', metric,
+            {'JobFlowId': cluster.id}, period))
+    values = get_metric_values(queries, monitoring_interval_secs, role=role)
+
+    result = {'nodes': {}, 'yarn': {}}
+    for metric, key in EMR_CLUSTER_METRICS.iteritems():
+        result['yarn'][key] = values[metric.lower()]
+    mem = 1.0 - result['yarn']['memory_available'] / 100.0
+    for i, node in enumerate(nodes):
+        result['nodes'][node['host']] = {
+            'cpu': values['cpu%s' % i] / 100.0,
+            'mem': mem,
+            'sysload': float('NaN')
+        }
+    return result
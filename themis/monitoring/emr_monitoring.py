@@ -1,18 +1,25 @@
-import subprocess
+import subprocess32 as subprocess
 import re
 import os
+import csv
 import json
 import math
 import time
+import urllib
+import threading
+import warnings
+import numpy
+import requests
 import themis
 import traceback
 from datetime import timedelta, datetime
-from scipy import integrate
 from themis import constants, config
-from themis.util import aws_common, common, math_util
+from themis.util import aws_common, common, math_util, timeseries
 from themis.util.common import *
 from themis.config import SECTION_EMR
 from themis.util.remote import run_ssh
+from themis.util.exceptions import ConnectivityException
+from themis.monitoring import emr_cloudwatch
 from themis.model.resources_model import *
 import themis.model.emr_model
 
@@ -25,98 +32,305 @@ MONITORING_INTERVAL_SECS = 60 * 10
 # default minimum task nodes
 DEFAULT_MIN_TASK_NODES = 1
 
-
-def remove_array_with_NaN(array):
-    i = 0
-    while i < len(array):
-        for item in array[i]:
-            if item == 'NaN' or math.isnan(item):
-                del array[i]
-                i -= 1
-                break
-        i += 1
-    return array
-
-
-def get_time_duration(datapoints):
-    start = float('inf')
-    end = 0
-    for d in datapoints:
-        if d[1] > end:
-            end = d[1]
-        if d[1] < start:
-            start = d[1]
-    return end - start
-
-
-def get_ganglia_datapoints(cluster, host, type, monitoring_interval_secs):
-    diff_secs = monitoring_interval_secs
-    format = "%m/%d/%Y %H:%M"
-    start_time, end_time = get_start_and_end(diff_secs, format)
-    type_param = ('%s_report' % type) if type in ('mem', 'cpu', 'load') else 'invalid'
-    url_pattern = 'http://%s/ganglia/graph.php?h=%s&cs=%s&ce=%s&c=%s&g=%s&json=1'
+# states of clusters that are not terminated (yet)
+CLUSTER_STATES_ACTIVE = ('STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING', 'TERMINATING')
+
+# HTTP port of the Presto coordinator
+PRESTO_COORDINATOR_PORT = 8889
+
+# seconds to use SSH instead of direct coordinator connections after a connection failure
+PRESTO_DIRECT_RETRY_SECS = 60 * 10
+
+# maps cluster IPs to the last time a direct Presto coordinator connection failed
+PRESTO_DIRECT_FAILURES = {}
+PRESTO_DIRECT_FAILURES_LOCK = threading.Lock()
+
+# Ganglia metrics fetched for all hosts of a cluster in bulk, mapped to
+# the corresponding curve names of the per-host Ganglia reports
+GANGLIA_BULK_METRICS = {
+    'cpu_idle': 'cpu_idle',
+    'bmem_total': 'bmem_total',
+    'bmem_free': 'bmem_free',
+    'load_one': 'a0'
+}
+
+# names of the curves contained in the per-host Ganglia report of each type
+GANGLIA_REPORT_CURVES = {
+    'cpu': ('cpu_idle', ),
+    'mem': ('bmem_total', 'bmem_free'),
+    'load': ('a0', )
+}
+
+# seconds of Ganglia history to re-fetch before the last buffered datapoint (to pick up late values)
+GANGLIA_FETCH_OVERLAP_SECS = 60
+
+# rolling windows of Ganglia datapoints, keyed by (cluster ID, host IP, curve name, monitoring interval).
+# Callers with different monitoring intervals (e.g., the monitoring loop and the API) use separate
+# windows, so that the shorter interval does not evict the datapoints required by the longer one.
+GANGLIA_WINDOWS = {}
+GANGLIA_WINDOWS_LOCK = threading.RLock()
+
+# seconds after which the primary (private) Ganglia address of a cluster is probed again,
+# if requests are currently routed to the alternative (public) address
+GANGLIA_ENDPOINT_REPROBE_SECS = 60 * 10
+
+# seconds to skip Ganglia requests for a cluster after all its addresses were unreachable
+# (doubled for each consecutive failure, up to the given maximum)
+GANGLIA_DOWN_RETRY_SECS = 30
+GANGLIA_DOWN_MAX_RETRY_SECS = 60 * 10
+
+# curl exit codes indicating that the host could not be reached
+CURL_CONNECTIVITY_ERRORS = (6, 7, 28)
+
+# maps cluster IDs to the state of their Ganglia endpoints (last working address,
+# time of the last re-probe, consecutive failures, and time until the cluster is skipped)
+GANGLIA_ENDPOINTS = {}
+GANGLIA_ENDPOINTS_LOCK = threading.RLock()
+
+# groups of nodes for which aggregate statistics are computed, with their instance group type
+NODE_GROUPS = (
+    ('allnodes', None),
+    ('tasknodes', aws_common.INSTANCE_GROUP_TYPE_TASK),
+    ('corenodes', aws_common.INSTANCE_GROUP_TYPE_CORE),
+    ('masternodes', aws_common.INSTANCE_GROUP_TYPE_MASTER)
+)
+NODE_LOAD_METRICS = ('cpu', 'mem', 'sysload')
+NODE_PERCENTILES = (50, 90, 99)
+NODE_AGGREGATES = ('average', 'sum', 'min', 'max', 'stddev') + tuple('p%s' % p for p in NODE_PERCENTILES)
+
+
+def get_ganglia_json(cluster, query):
+    url_pattern = 'http://%s/ganglia/graph.php?%s'
+    fetch_mode = config.get_value(constants.KEY_GANGLIA_FETCH_MODE, default=constants.GANGLIA_FETCH_MODE_HTTP)
+    connect_timeout = float(config.get_value(constants.KEY_GANGLIA_CONNECT_TIMEOUT, default=HTTP_CONNECT_TIMEOUT))
+    read_timeout = float(config.get_value(constants.KEY_GANGLIA_READ_TIMEOUT, default=HTTP_READ_TIMEOUT))
     result = None
     error = None
+    unreachable = True
     # In some cases Ganglia is only available via public IP address
     # (necessary if running the autoscaling webserver outside AWS)
-    for ip in [cluster.ip, cluster.ip_public]:
+    for ip in get_ganglia_endpoints(cluster):
         try:
-            url = url_pattern % (ip, host, start_time, end_time, cluster.id, type_param)
-            cmd = "curl --connect-timeout %s '%s' 2> /dev/null" % (CURL_CONNECT_TIMEOUT, url)
-            result = run(cmd, GANGLIA_CACHE_TIMEOUT)
-            result = json.loads(result)
+            url = url_pattern % (ip, query)
+            if fetch_mode == constants.GANGLIA_FETCH_MODE_CURL:
+                cmd = "curl --connect-timeout %s --max-time %s '%s' 2> /dev/null" % (
+                    connect_timeout, connect_timeout + read_timeout, url)
+                result = json.loads(run(cmd, GANGLIA_CACHE_TIMEOUT))
+            else:
+                result = run_func(http_get_json, url=url, connect_timeout=connect_timeout,
+                    read_timeout=read_timeout, cache_duration_secs=GANGLIA_CACHE_TIMEOUT)
             LOG.debug('datapoints={}'.format(json.dumps(result)))
+            update_ganglia_endpoint(cluster, ip)
             return result
         except Exception, e:
             error = e
+            unreachable = unreachable and is_connectivity_error(e)
             # try next IP
+    if unreachable:
+        update_ganglia_endpoint(cluster, None)
     raise error
 
 
-def get_node_load_part(cluster, host, type, monitoring_interval_secs=MONITORING_INTERVAL_SECS):
-    ganglia_data = get_ganglia_datapoints(cluster, host, type, monitoring_interval_secs)
-    if not ganglia_data:
-        return float('NaN')
-    curves_map = {}
-    datapoints_map = {}
+def get_ganglia_endpoints(cluster):
+    """
+    Return the addresses under which to try reaching Ganglia for the given cluster, the address
+    that worked last time first. Raises a ConnectivityException while the cluster is considered down.
+    """
+    addresses = []
+    for ip in (cluster.ip, cluster.ip_public):
+        if ip and ip not in addresses:
+            addresses.append(ip)
+    if not addresses:
+        raise ConnectivityException('No Ganglia address known for cluster %s' % cluster.id)
+    with GANGLIA_ENDPOINTS_LOCK:
+        state = GANGLIA_ENDPOINTS.setdefault(cluster.id, {})
+        time_now = now()
+        if state.get('down_until', 0) > time_now:
+            raise ConnectivityException('Ganglia of cluster %s unreachable, skipping requests for %s secs' %
+                (cluster.id, int(state['down_until'] - time_now)))
+        preferred = state.get('address')
+        if preferred not in addresses or preferred == addresses[0]:
+            return addresses
+        if time_now - state.get('probed', 0) >= GANGLIA_ENDPOINT_REPROBE_SECS:
+            # periodically check whether the primary address has become reachable again
+            state['probed'] = time_now
+            return addresses
+        return [preferred] + [ip for ip in addresses if ip != preferred]
+
+
+def update_ganglia_endpoint(cluster, address):
+    """ Record a successful request to the given Ganglia address, or a failure of all addresses (None). """
+    with GANGLIA_ENDPOINTS_LOCK:
+        state = GANGLIA_ENDPOINTS.setdefault(cluster.id, {})
+        if address:
+            if state.get('address') != address:
+                state['address'] = address
+                state['probed'] = now()
+            state['failures'] = 0
+            state.pop('down_until', None)
+            return
+        failures = state['failures'] = state.get('failures', 0) + 1
+        retry_secs = min(GANGLIA_DOWN_RETRY_SECS * 2 ** (failures - 1), GANGLIA_DOWN_MAX_RETRY_SECS)
+        state['down_until'] = now() + retry_secs
+        LOG.warning('Ganglia of cluster %s unreachable via %s, retrying in %s secs' %
+            (cluster.id, [cluster.ip, cluster.ip_public], retry_secs))
+
+
+def is_connectivity_error(e):
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, subprocess.TimeoutExpired)):
+        return True
+    return isinstance(e, subprocess.CalledProcessError) and e.returncode in CURL_CONNECTIVITY_ERRORS
+
+
+def get_ganglia_datapoints(cluster, host, type, monitoring_interval_secs):
+    diff_secs = monitoring_interval_secs
+    format = "%m/%d/%Y %H:%M"
+    start_time, end_time = get_start_and_end(diff_secs, format)
+    type_param = ('%s_report' % type) if type in ('mem', 'cpu', 'load') else 'invalid'
+    query = 'h=%s&cs=%s&ce=%s&c=%s&g=%s&json=1' % (host, start_time, end_time, cluster.id, type_param)
+    return get_ganglia_json(cluster, query)
+
+
+def get_ganglia_cluster_datapoints(cluster, monitoring_interval_secs):
+    """
+    Get the raw datapoints of all bulk metrics (see GANGLIA_BULK_METRICS) for all hosts
+    of a cluster, using a single aggregate graph request. Returns one curve per host and metric.
+    """
+    diff_secs = monitoring_interval_secs
+    format = "%m/%d/%Y %H:%M"
+    start_time, end_time = get_start_and_end(diff_secs, format, escape=False)
+    metrics_regex = '^(%s)$' % '|'.join(GANGLIA_BULK_METRICS.keys())
+    query = urllib.urlencode([('c', cluster.id), ('cs', start_time), ('ce', end_time),
+        ('hreg[]', '.*'), ('mreg[]', metrics_regex), ('aggregate', '1'), ('gtype', 'line'), ('json', '1')])
+    return get_ganglia_json(cluster, query)
 
+
+def get_ganglia_curves(ganglia_data):
+    curves_map = {}
     for curve in ganglia_data:
-        datapoints = curve['datapoints']
-        remove_array_with_NaN(datapoints)
-        rev_curve = array_reverse(datapoints)
-        curve_ds_name = curve['ds_name']
-        curves_map[curve_ds_name] = rev_curve
-        datapoints_map[curve_ds_name] = datapoints
-
-    if type == 'cpu':
-        curve_cpu_idle = curves_map['cpu_idle']
-        if len(curve_cpu_idle) < 2:
-            return float('NaN')
-        integrated = integrate.simps(curve_cpu_idle[0], curve_cpu_idle[1])
-        time_duration = get_time_duration(datapoints_map['cpu_idle'])
-        total = time_duration * 100.0
-        percent = 1.0 - (integrated / total)
-        return percent
-
-    elif type == 'mem':
-        curve_bmem_total = curves_map['bmem_total']
-        curve_bmem_free = curves_map['bmem_free']
-        if len(curve_bmem_total) < 2:
-            return float('NaN')
-        mem_total = integrate.simps(curve_bmem_total[0], curve_bmem_total[1])
-        mem_free = integrate.simps(curve_bmem_free[0], curve_bmem_free[1])
-        if mem_total == 0:
-            return float('NaN')
-        return 1.0 - (mem_free / mem_total)
-
-    elif type == 'load':
-        curve_load = curves_map['a0']
-        if len(curve_load) < 2:
-            return float('NaN')
-        avg_load = math_util.get_stats(curve_load[0])['avg']
-        return avg_load
-
-    return float('NaN')
+        curves_map[curve['ds_name']] = to_curve_array(curve['datapoints'])
+    return curves_map
+
+
+def to_curve_array(datapoints):
+    """
+    Convert a list of Ganglia datapoints ([value, timestamp] pairs) into a
+    numpy array with one row per datapoint, removing all rows containing NaN.
+    """
+    array = numpy.array(datapoints, dtype=float).reshape(-1, 2)
+    return array[~numpy.isnan(array).any(axis=1)]
+
+
+def is_incremental_fetch_enabled():
+    return config.get_value(constants.KEY_GANGLIA_INCREMENTAL_FETCH, default='true') == 'true'
+
+
+def get_ganglia_window(cluster_id, host, curve_name, monitoring_interval_secs):
+    key = (cluster_id, aws_common.hostname_to_ip(host), curve_name, int(monitoring_interval_secs))
+    GANGLIA_WINDOWS_LOCK.acquire()
+    try:
+        window = GANGLIA_WINDOWS.get(key)
+        if not window:
+            window = GANGLIA_WINDOWS[key] = timeseries.RollingWindow(int(monitoring_interval_secs))
+        return window
+    finally:
+        GANGLIA_WINDOWS_LOCK.release()
+
+
+def get_ganglia_fetch_secs(cluster_id, hosts, curve_names, monitoring_interval_secs):
+    """
+    Get the number of seconds of Ganglia history to fetch for the given hosts. If incremental
+    fetching is enabled, only the datapoints after the oldest of the last buffered datapoints
+    (plus some overlap) need to be fetched; otherwise, the whole monitoring interval is fetched.
+    """
+    if not is_incremental_fetch_enabled():
+        return monitoring_interval_secs
+    last_timestamps = [get_ganglia_window(cluster_id, host, name, monitoring_interval_secs).last_timestamp()
+        for host in hosts for name in curve_names]
+    if not last_timestamps or None in last_timestamps:
+        return monitoring_interval_secs
+    fetch_secs = time.time() - min(last_timestamps) + GANGLIA_FETCH_OVERLAP_SECS
+    return int(max(0, min(fetch_secs, monitoring_interval_secs)))
+
+
+def update_ganglia_windows(cluster_id, host, curves_map, curve_names, monitoring_interval_secs):
+    """
+    Merge freshly fetched curves into the rolling windows of the given host (if incremental
+    fetching is enabled), and return the curves covering the whole monitoring interval.
+    """
+    if not is_incremental_fetch_enabled():
+        return curves_map
+    result = {}
+    for name in curve_names:
+        window = get_ganglia_window(cluster_id, host, name, monitoring_interval_secs)
+        result[name] = window.update(curves_map.get(name, numpy.empty((0, 2))))
+    return result
+
+
+def evict_ganglia_windows(cluster_id, hosts):
+    """ Remove the rolling windows of all hosts which are no longer part of the given cluster. """
+    host_ips = set([aws_common.hostname_to_ip(host) for host in hosts])
+    GANGLIA_WINDOWS_LOCK.acquire()
+    try:
+        for key in list(GANGLIA_WINDOWS.keys()):
+            if key[0] == cluster_id and key[1] not in host_ips:
+                del GANGLIA_WINDOWS[key]
+    finally:
+        GANGLIA_WINDOWS_LOCK.release()
+
+
+def get_node_load_part(cluster, host, type, monitoring_interval_secs=MONITORING_INTERVAL_SECS):
+    curve_names = GANGLIA_REPORT_CURVES.get(type, ())
+    fetch_secs = get_ganglia_fetch_secs(cluster.id, [host], curve_names, monitoring_interval_secs)
+    ganglia_data = get_ganglia_datapoints(cluster, host, type, fetch_secs)
+    curves_map = get_ganglia_curves(ganglia_data or [])
+    curves_map = update_ganglia_windows(cluster.id, host, curves_map, curve_names, monitoring_interval_secs)
+    return compute_node_load_part(curves_map, type)
+
+
+def compute_node_load_part(curves_map, type):
+    load_key = 'sysload' if type == 'load' else type
+    return compute_node_loads({None: curves_map})[None].get(load_key, float('NaN'))
+
+
+def compute_node_loads(curves_by_host):
+    """
+    Compute the cpu, mem and sysload values of multiple hosts from their Ganglia curves (see
+    get_ganglia_curves). The curves of all hosts are integrated in batched array operations.
+    """
+    keys = []
+    curves = []
+    for host, curves_map in curves_by_host.iteritems():
+        for ds_name in ('cpu_idle', 'bmem_total', 'bmem_free'):
+            curve = curves_map.get(ds_name)
+            if curve is not None and len(curve) >= 2:
+                keys.append((host, ds_name))
+                curves.append(curve)
+    integrals = dict(zip(keys, math_util.integrate_curves(curves)))
+
+    result = {}
+    for host, curves_map in curves_by_host.iteritems():
+        load = result[host] = {}
+        load['cpu'] = float('NaN')
+        load['mem'] = float('NaN')
+        load['sysload'] = float('NaN')
+
+        if (host, 'cpu_idle') in integrals:
+            timestamps = curves_map['cpu_idle'][:, 1]
+            total = (timestamps.max() - timestamps.min()) * 100.0
+            if total > 0:
+                load['cpu'] = 1.0 - (integrals[(host, 'cpu_idle')] / total)
+
+        if (host, 'bmem_total') in integrals and (host, 'bmem_free') in integrals:
+            mem_total = integrals[(host, 'bmem_total')]
+            mem_free = integrals[(host, 'bmem_free')]
+            if mem_total != 0:
+                load['mem'] = 1.0 - (mem_free / mem_total)
+
+        curve_load = curves_map.get('a0')
+        if curve_load is not None and len(curve_load) >= 2:
+            load['sysload'] = float(curve_load[:, 0].mean())
+    return result
 
 
 def get_node_load_cpu(cluster, host, monitoring_interval_secs=MONITORING_INTERVAL_SECS):
@@ -143,6 +357,38 @@ def get_node_load(cluster, host, monitoring_interval_secs=MONITORING_INTERVAL_SE
     return result
 
 
+def get_cluster_load_bulk(cluster, monitoring_interval_secs=MONITORING_INTERVAL_SECS, hosts=None):
+    """
+    Get the load of all nodes in the cluster from a single Ganglia request. Hosts for
+    which not all bulk metrics are available are omitted from the result. If the list of
+    expected hosts is given, only the data missing from their rolling windows is fetched.
+    """
+    curve_names = GANGLIA_BULK_METRICS.values()
+    fetch_secs = monitoring_interval_secs
+    if hosts:
+        fetch_secs = get_ganglia_fetch_secs(cluster.id, hosts, curve_names, monitoring_interval_secs)
+    ganglia_data = get_ganglia_cluster_datapoints(cluster, fetch_secs)
+    host_curves = {}
+    for curve in ganglia_data or []:
+        host = curve.get('host_name')
+        metric = curve.get('metric_name')
+        if metric not in GANGLIA_BULK_METRICS:
+            metric = curve.get('ds_name')
+        if not host or metric not in GANGLIA_BULK_METRICS:
+            continue
+        if host not in host_curves:
+            host_curves[host] = []
+        host_curves[host].append({'ds_name': GANGLIA_BULK_METRICS[metric], 'datapoints': curve['datapoints']})
+
+    curves_by_host = {}
+    for host, curves in host_curves.iteritems():
+        if len(curves) >= len(GANGLIA_BULK_METRICS):
+            curves_map = get_ganglia_curves(curves)
+            curves_by_host[host] = update_ganglia_windows(cluster.id, host, curves_map,
+                curve_names, monitoring_interval_secs)
+    return compute_node_loads(curves_by_host)
+
+
 def get_cluster_load(cluster, nodes=None, monitoring_interval_secs=MONITORING_INTERVAL_SECS):
     result = {}
     role = get_iam_role_for_cluster(cluster)
@@ -150,6 +396,28 @@ def get_cluster_load(cluster, nodes=None, monitoring_interval_secs=MONITORING_IN
     if not nodes:
         nodes = aws_common.get_cluster_nodes(cluster.id, role=role)
 
+    hosts = [node['host'] for node in nodes]
+    evict_ganglia_windows(cluster.id, hosts)
+
+    bulk_loads = {}
+    if config.get_value(constants.KEY_GANGLIA_BULK_FETCH, default='true') == 'true':
+        try:
+            bulk_loads = get_cluster_load_bulk(cluster, monitoring_interval_secs, hosts=hosts)
+        except Exception, e:
+            LOG.info('Unable to get bulk Ganglia data for cluster %s, using per-host requests: %s' % (cluster.id, e))
+        # Ganglia may know the hosts by their IP-based names only (e.g., if a custom domain name is configured)
+        for host in list(bulk_loads.keys()):
+            bulk_loads.setdefault(aws_common.hostname_to_ip(host), bulk_loads[host])
+
+    remaining_nodes = []
+    for node in nodes:
+        host = node['host']
+        load = bulk_loads.get(host) or bulk_loads.get(aws_common.hostname_to_ip(host))
+        if load:
+            result[host] = load
+        else:
+            remaining_nodes.append(node)
+
     def query(node):
         host = node['host']
         try:
@@ -160,37 +428,81 @@ def get_cluster_load(cluster, nodes=None, monitoring_interval_secs=MONITORING_IN
             LOG.error("Unable to get load for node %s: %s" % (host, e))
             result[host] = {}
 
-    parallelize(nodes, query)
+    parallelize(remaining_nodes, query)
     return result
 
 
-def get_presto_node_states(nodes, cluster_ip):
-    def query(host, node_info):
-        node_info['presto_state'] = 'N/A'
+def get_presto_node_states(nodes, cluster):
+    state_source = config.get_value(constants.KEY_PRESTO_STATE_SOURCE, section=SECTION_EMR,
+        resource=cluster.id, default=constants.PRESTO_STATE_SOURCE_COORDINATOR)
+    if state_source == constants.PRESTO_STATE_SOURCE_COORDINATOR:
         try:
-            if node_info['state'] == aws_common.INSTANCE_STATE_RUNNING:
-                state = aws_common.get_presto_node_state(cluster_ip, host)
-                node_info['presto_state'] = state
+            states = get_presto_node_states_from_coordinator(cluster)
+            if not states:
+                raise Exception('No Presto nodes reported by coordinator')
+            for host, node_info in nodes.iteritems():
+                node_info['presto_state'] = 'N/A'
+                if node_info['state'] == aws_common.INSTANCE_STATE_RUNNING:
+                    # nodes unknown to the coordinator have no running Presto process
+                    node_info['presto_state'] = states.get(host, 'N/A')
+            return
         except Exception, e:
-            if host[0:9] == 'testhost-':
-                # for testing purposes
-                node_info['presto_state'] = aws_common.PRESTO_STATE_ACTIVE
-            # swallow this exception. It occurs if the node has been shutdown (i.e., JVM
-            # process on node is terminated) but the instance has not been terminated yet
-            pass
+            LOG.info('Unable to get Presto node states from coordinator of cluster %s, querying nodes: %s' %
+                (cluster.id, e))
 
-    parallelize(nodes, query)
+    running = [host for host, node_info in nodes.iteritems() if node_info['state'] == aws_common.INSTANCE_STATE_RUNNING]
+    states = {}
+    try:
+        if running:
+            states = aws_common.get_presto_node_states(cluster.ip, running)
+    except Exception, e:
+        LOG.info('Unable to query Presto node states of cluster %s: %s' % (cluster.id, e))
+    for host, node_info in nodes.iteritems():
+        # the state is missing if the node has been shutdown (i.e., JVM process
+        # on node is terminated) but the instance has not been terminated yet
+        node_info['presto_state'] = states.get(host) or 'N/A'
+        if host in running and host[0:9] == 'testhost-' and not states.get(host):
+            # for testing purposes
+            node_info['presto_state'] = aws_common.PRESTO_STATE_ACTIVE
+
+
+def get_presto_node_states_from_coordinator(cluster):
+    """
+    Get the Presto states of all nodes known to the coordinator of the cluster, using a
+    single query of system.runtime.nodes. Returns a map of host names to node states.
+    """
+    rows = run_coordinator_query(cluster, 'SELECT http_uri, state FROM system.runtime.nodes')
+    dn = get_cluster_domain_name(cluster)
+    result = {}
+    for row in rows:
+        match = re.match(r'.*http://([0-9\.]+):.*', row[0])
+        if match and len(row) > 1:
+            host = aws_common.ip_to_hostname(match.group(1), dn)
+            result[host] = row[1].upper()
+    return result
 
 
-def get_node_queries(cluster):
-    cmd = ('presto-cli --execute \\"SELECT n.http_uri,count(q.node_id) from system.runtime.nodes n ' +
-        'left join (select * from system.runtime.queries where state = \'RUNNING\' ) as q ' +
-        'on q.node_id = n.node_id group by n.http_uri\\"')
+def run_coordinator_query(cluster, sql):
+    """
+    Run a query on the Presto coordinator of the cluster and return the result rows. The query
+    is sent directly to the coordinator using a pooled connection; if the coordinator is not
+    reachable directly, the query is run via presto-cli over SSH on the master node.
+    """
+    with PRESTO_DIRECT_FAILURES_LOCK:
+        last_failure = PRESTO_DIRECT_FAILURES.get(cluster.ip, 0)
+    if last_failure < now() - PRESTO_DIRECT_RETRY_SECS:
+        try:
+            result = run_func(run_presto_query, presto_sql=sql, hostname=cluster.ip,
+                port=PRESTO_COORDINATOR_PORT, cache_duration_secs=QUERY_CACHE_TIMEOUT)
+            with PRESTO_DIRECT_FAILURES_LOCK:
+                PRESTO_DIRECT_FAILURES.pop(cluster.ip, None)
+            return result
+        except Exception, e:
+            LOG.debug('Unable to connect to Presto coordinator %s, using SSH: %s' % (cluster.ip, e))
+            with PRESTO_DIRECT_FAILURES_LOCK:
+                PRESTO_DIRECT_FAILURES[cluster.ip] = now()
 
-    result = {}
-    if cluster.ip == 'localhost':
-        # for testing purposes
-        return result
+    cmd = 'presto-cli --execute \\"%s\\"' % sql
 
     # run ssh command
     out = run_ssh(cmd, cluster.ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
@@ -198,18 +510,35 @@ def get_node_queries(cluster):
     # remove SSH log output line
     out = remove_lines_from_string(out, r'.*Permanently added.*')
 
+    return [row for row in csv.reader(out.splitlines()) if row]
+
+
+def get_cluster_domain_name(cluster):
     # read config for domain
     custom_dn = config.get_value(constants.KEY_CUSTOM_DOMAIN_NAME, section=SECTION_EMR, resource=cluster.id)
     # assume input is actually domain name (not ip)
-    dn = custom_dn if custom_dn else re.match(r'ip-[^\.]+\.(.+)', cluster.ip).group(1)
+    return custom_dn if custom_dn else re.match(r'ip-[^\.]+\.(.+)', cluster.ip).group(1)
+
 
-    for line in out.splitlines():
-        ip = re.sub(r'.*http://([0-9\.]+):.*', r'\1', line)
-        if ip:
-            queries = re.sub(r'.*"([0-9\.]+)"$', r'\1', line)
-            host = aws_common.ip_to_hostname(ip, dn)
+def get_node_queries(cluster):
+    sql = ('SELECT n.http_uri,count(q.node_id) from system.runtime.nodes n ' +
+        'left join (select * from system.runtime.queries where state = \'RUNNING\' ) as q ' +
+        'on q.node_id = n.node_id group by n.http_uri')
+
+    result = {}
+    if cluster.ip == 'localhost':
+        # for testing purposes
+        return result
+
+    rows = run_coordinator_query(cluster, sql)
+    dn = get_cluster_domain_name(cluster)
+
+    for row in rows:
+        match = re.match(r'.*http://([0-9\.]+):.*', row[0])
+        if match:
+            host = aws_common.ip_to_hostname(match.group(1), dn)
             try:
-                result[host] = int(queries)
+                result[host] = int(row[1])
             except Exception, e:
                 result[host] = 0
     return result
@@ -223,83 +552,107 @@ def get_idle_task_nodes(queries):
     return result
 
 
-def do_add_stats(nodelist, result_map):
-
-    load_aggregates = ('average', 'sum', 'min', 'max')
-    all_aggregates = load_aggregates + ('count', )
-    load_metrics = ('cpu', 'mem', 'sysload')
-    all_metrics = load_metrics + ('queries', )
-
-    # initialize maps
-    map_min = {}
-    map_max = {}
-    map_sum = {}
-    for m in all_metrics:
-        map_min[m] = 100.0
-        map_max[m] = 0.0
-        map_sum[m] = 0.0
-    for agg in all_aggregates:
-        result_map[agg] = {}
-    result_map['running'] = True
-    result_map['active'] = True
-
-    for item in nodelist:
-        if 'load' in item:
-            for metr in load_metrics:
-                item_value = item['load'].get(metr)
-                if is_float(item_value):
-                    if item_value > map_max[metr]:
-                        map_max[metr] = item_value
-                    if item_value < map_min[metr]:
-                        map_min[metr] = item_value
-                    map_sum[metr] += item_value
-
-        if 'queries' in item:
-            map_sum['queries'] += item['queries']
-        if 'state' not in item:
-            item['state'] = 'N/A'
-        if item['state'] != aws_common.INSTANCE_STATE_RUNNING:
-            result_map['running'] = False
-        if 'presto_state' not in item:
-            item['presto_state'] = 'N/A'
-        if item['presto_state'] != aws_common.PRESTO_STATE_ACTIVE:
-            if result_map['active']:
-                LOG.debug('Presto status of node %s is %s, setting "<nodes>.active=False"' % (item.get('host'),
-                                                                                              item['presto_state']))
-            result_map['active'] = False
-
-    # initialize result map with NaN values
-    for metric in all_metrics:
-        for aggr in load_aggregates:
-            if aggr not in ('min', 'max') or metric not in ('queries'):
-                result_map[aggr][metric] = 'NaN'
-    # set actual node values
-    if len(nodelist) > 0:
-        for metr in all_metrics:
-            result_map['average'][metr] = map_sum[metr] / len(nodelist)
-        for metr in load_metrics:
-            result_map['sum'][metr] = map_sum[metr]
-            result_map['min'][metr] = map_min[metr]
-            result_map['max'][metr] = map_max[metr]
-    result_map['sum']['queries'] = map_sum['queries']
-    result_map['count']['nodes'] = len(nodelist)
-    LOG.debug('result={}'.format(json.dumps(result_map)))
+class NodeTable(object):
+    """
+    Columnar view of the nodes of a cluster: one numpy array per metric (NaN for missing
+    values) and one per categorical attribute, which allows computing the aggregate
+    statistics of all node groups in a single vectorized pass.
+    """
+
+    def __init__(self, nodes_list):
+        self.size = len(nodes_list)
+        self.nodes = nodes_list
+        self.columns = {}
+        for node in nodes_list:
+            if 'state' not in node:
+                node['state'] = 'N/A'
+            if 'presto_state' not in node:
+                node['presto_state'] = 'N/A'
+        for metric in NODE_LOAD_METRICS:
+            self.columns[metric] = numpy.array([self.to_value(n.get('load', {}).get(metric))
+                for n in nodes_list], dtype=float)
+        self.columns['queries'] = numpy.array([n.get('queries', float('NaN')) for n in nodes_list], dtype=float)
+        for attr in ('type', 'market', 'state', 'presto_state'):
+            self.columns[attr] = numpy.array([n.get(attr) for n in nodes_list], dtype=object)
+
+    @staticmethod
+    def to_value(value):
+        return value if is_float(value) else float('NaN')
+
+    def get_group_masks(self):
+        masks = numpy.zeros((len(NODE_GROUPS), self.size), dtype=bool)
+        for i, (group, node_type) in enumerate(NODE_GROUPS):
+            masks[i] = True if node_type is None else self.columns['type'] == node_type
+        return masks
+
+    def aggregate(self):
+        masks = self.get_group_masks()
+        counts = masks.sum(axis=1)
+        result = {}
+        for i, (group, node_type) in enumerate(NODE_GROUPS):
+            result_map = result[group] = {}
+            for aggr in NODE_AGGREGATES:
+                result_map[aggr] = {}
+            result_map['count'] = {'nodes': int(counts[i])}
+            result_map['running'] = bool(numpy.all(self.columns['state'][masks[i]] ==
+                aws_common.INSTANCE_STATE_RUNNING))
+            inactive = numpy.flatnonzero(masks[i] & (self.columns['presto_state'] != aws_common.PRESTO_STATE_ACTIVE))
+            result_map['active'] = len(inactive) <= 0
+            if len(inactive) > 0:
+                node = self.nodes[inactive[0]]
+                LOG.debug('Presto status of node %s is %s, setting "<nodes>.active=False"' %
+                    (node.get('host'), node['presto_state']))
+
+        for metric in NODE_LOAD_METRICS + ('queries', ):
+            stats = self.get_group_stats(self.columns[metric], masks)
+            for i, (group, node_type) in enumerate(NODE_GROUPS):
+                result_map = result[group]
+                for aggr in NODE_AGGREGATES:
+                    if metric == 'queries' and aggr in ('min', 'max'):
+                        continue
+                    value = stats[aggr][i] if stats else float('NaN')
+                    result_map[aggr][metric] = 'NaN' if numpy.isnan(value) else float(value)
+                if metric == 'queries' and counts[i] <= 0:
+                    result_map['sum'][metric] = 0.0
+        for group, node_type in NODE_GROUPS:
+            LOG.debug('result={}'.format(json.dumps(result[group])))
+        return result
+
+    def get_group_stats(self, column, masks):
+        """
+        Compute the aggregates of a metric column for all groups (rows of masks) at once. Missing
+        (NaN) values of nodes in a group count as zero for sum, average, stddev and percentiles,
+        i.e., these statistics are consistent with each other and computed over all nodes of the
+        group. min and max are bounds of the reported values only (missing values are skipped).
+        Groups without nodes yield NaN for all aggregates.
+        """
+        if self.size <= 0:
+            return None
+        counts = masks.sum(axis=1)
+        values = numpy.where(masks, column, numpy.nan)
+        # values of the group members, with missing values counted as zero (NaN for non-members)
+        filled = numpy.where(masks, numpy.where(numpy.isnan(column), 0.0, column), numpy.nan)
+        has_nodes = counts > 0
+        stats = {}
+        with warnings.catch_warnings():
+            # groups without nodes (or valid values) yield NaN, which is what we want here
+            warnings.simplefilter('ignore', RuntimeWarning)
+            sums = numpy.nansum(filled, axis=1)
+            stats['sum'] = numpy.where(has_nodes, sums, numpy.nan)
+            stats['average'] = numpy.where(has_nodes, sums / numpy.maximum(counts, 1), numpy.nan)
+            stats['min'] = numpy.where(has_nodes, numpy.fmin(numpy.nanmin(values, axis=1), 100.0), numpy.nan)
+            stats['max'] = numpy.where(has_nodes, numpy.fmax(numpy.nanmax(values, axis=1), 0.0), numpy.nan)
+            stats['stddev'] = numpy.where(has_nodes, numpy.nanstd(filled, axis=1), numpy.nan)
+            percentiles = numpy.nanpercentile(filled, NODE_PERCENTILES, axis=1)
+            for percentile, row in zip(NODE_PERCENTILES, percentiles):
+                stats['p%s' % percentile] = numpy.where(has_nodes, row, numpy.nan)
+        return stats
 
 
 def add_stats(data):
     if 'nodes_list' in data:
-        data['allnodes'] = {}
-        do_add_stats(data['nodes_list'], data['allnodes'])
-
-        data['tasknodes'] = {}
-        data['corenodes'] = {}
-        data['masternodes'] = {}
-        task_nodes = [n for n in data['nodes_list'] if n['type'] == aws_common.INSTANCE_GROUP_TYPE_TASK]
-        do_add_stats(task_nodes, data['tasknodes'])
-        master_nodes = [n for n in data['nodes_list'] if n['type'] == aws_common.INSTANCE_GROUP_TYPE_MASTER]
-        do_add_stats(master_nodes, data['masternodes'])
-        core_nodes = [n for n in data['nodes_list'] if n['type'] == aws_common.INSTANCE_GROUP_TYPE_CORE]
-        do_add_stats(core_nodes, data['corenodes'])
+        table = NodeTable(data['nodes_list'])
+        data.update(table.aggregate())
 
 
 def collect_info(cluster, nodes=None, config=None,
@@ -314,9 +667,11 @@ def collect_info(cluster, nodes=None, config=None,
         result['nodes'] = {}
         result['cluster_id'] = cluster.id
         result['is_presto'] = cluster.type == aws_common.CLUSTER_TYPE_PRESTO
+        role = get_iam_role_for_cluster(cluster)
+        # refresh the instance groups once per run, subsequent lookups are served from the index
+        aws_common.get_instance_group_index(cluster.id, role=role, refresh=True)
         nodes_list = nodes
         if not nodes_list:
-            role = get_iam_role_for_cluster(cluster)
             nodes_list = aws_common.get_cluster_nodes(cluster.id, role=role)
         for node in nodes_list:
             host = node['host']
@@ -339,16 +694,23 @@ def collect_info(cluster, nodes=None, config=None,
             entry = result['nodes'][host]
             entry['host'] = host
             result['nodes_list'].append(entry)
-        node_infos = get_cluster_load(cluster, nodes=nodes,
-            monitoring_interval_secs=monitoring_interval_secs)
+        if get_metrics_source(cluster) == constants.METRICS_SOURCE_CLOUDWATCH:
+            metrics = emr_cloudwatch.get_cluster_metrics(cluster, nodes_list, monitoring_interval_secs, role=role)
+            node_infos = metrics['nodes']
+            result['yarn'] = metrics['yarn']
+        else:
+            node_infos = get_cluster_load(cluster, nodes=nodes,
+                monitoring_interval_secs=monitoring_interval_secs)
         for host in node_infos:
             result['nodes'][host]['load'] = node_infos[host]
             if 'presto_state' in result['nodes'][host]:
                 result['nodes'][host]['presto_state'] = node_infos[host]
         if result['is_presto']:
-            get_presto_node_states(result['nodes'], cluster.ip)
+            get_presto_node_states(result['nodes'], cluster)
 
         add_stats(result)
+        # the scaling expressions read missing stats as None (see expr.AggregateStatsExpr), hence
+        # NaN values must be deleted from the state, not only when it is encoded as JSON
         remove_NaN(result)
         return result
 
@@ -377,35 +739,47 @@ def update_resources(resource_config, resource=None):
     return resource_config
 
 
-def list_all_clusters(role=None):
+def list_all_clusters(role=None, states=CLUSTER_STATES_ACTIVE):
     emr_client = aws_common.connect_emr(role=role)
+    paginator = emr_client.get_paginator('list_clusters')
     result = []
-    marker = None
-    for i in range(0, 10):
-        kwargs = {}
-        if marker:
-            kwargs['Marker'] = marker
-        out = emr_client.list_clusters(**kwargs)
-        result.extend(out['Clusters'])
-        marker = out.get('Marker')
-        if not marker:
-            break
+    for page in paginator.paginate(ClusterStates=list(states)):
+        result.extend(page['Clusters'])
     return result
 
 
+def get_metrics_source(cluster):
+    source = config.get_value(constants.KEY_METRICS_SOURCE, section=SECTION_EMR, resource=cluster.id)
+    if source in (constants.METRICS_SOURCE_GANGLIA, constants.METRICS_SOURCE_CLOUDWATCH):
+        return source
+    if getattr(cluster, 'has_ganglia', True):
+        return constants.METRICS_SOURCE_GANGLIA
+    return constants.METRICS_SOURCE_CLOUDWATCH
+
+
 def get_iam_role_for_cluster(cluster):
     if not isinstance(cluster, basestring):
         cluster = cluster.id
     return config.get_value('role_to_assume', section=SECTION_EMR, resource=cluster)
 
 
+def get_master_node(cluster_id, role=None):
+    """ Return the (first) running master instance of the given cluster, or None. """
+    emr_client = aws_common.connect_emr(role=role)
+    out = emr_client.list_instances(ClusterId=cluster_id, InstanceGroupTypes=[aws_common.INSTANCE_GROUP_TYPE_MASTER],
+        InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
+    for inst in out['Instances']:
+        return inst
+    return None
+
+
 def init_emr_config(run_parallel=False, role=None):
     cfg = ResourcesConfiguration()
 
     emr_client = aws_common.connect_emr(role=role)
 
     def init_emr_cluster_config(c):
-        if c['Status']['State'][0:10] != 'TERMINATED':
+        try:
             out1 = emr_client.describe_cluster(ClusterId=c['Id'])
             cluster_details = out1['Cluster']
             cluster = themis.model.emr_model.EmrCluster()
@@ -421,29 +795,28 @@ def init_emr_config(run_parallel=False, role=None):
                     cluster.type = 'Presto'
                 if app['Name'] == 'Ganglia':
                     has_ganglia = True
-            if has_ganglia:
-                LOG.info('Getting details for EMR cluster %s' % cluster.id)
-                # get private IP address of cluster
-                group_details = emr_client.list_instance_groups(ClusterId=c['Id'])
-                for g in group_details['InstanceGroups']:
-                    if g['InstanceGroupType'] == 'MASTER':
-                        out2 = emr_client.list_instances(ClusterId=c['Id'],
-                            InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'])
-                        for inst in out2['Instances']:
-                            if inst['InstanceGroupId'] == g['Id']:
-                                cluster.ip = inst['PrivateDnsName']
-                cfg.emr.append(cluster)
-            else:
-                LOG.info('Ignoring cluster %s (Ganglia not installed)' % cluster.id)
+            cluster.has_ganglia = has_ganglia
+            if not has_ganglia:
+                LOG.info('Cluster %s has no Ganglia installed, using CloudWatch metrics' % cluster.id)
+            LOG.info('Getting details for EMR cluster %s' % cluster.id)
+            # get private IP address of cluster
+            master = get_master_node(cluster.id, role=role)
+            if master:
+                cluster.ip = master['PrivateDnsName']
+            return cluster
+        except Exception, e:
+            # do not drop the other clusters of the role if the details of one cluster cannot be loaded
+            LOG.warning('Unable to get details for EMR cluster %s: %s' % (c['Id'], e))
+            return None
 
     # load EMR resources
     try:
         clusters = list_all_clusters(role=role)
         if run_parallel:
-            common.parallelize(clusters, init_emr_cluster_config)
+            result = common.parallelize(clusters, init_emr_cluster_config)
         else:
-            for c in clusters:
-                init_emr_cluster_config(c)
+            result = [init_emr_cluster_config(c) for c in clusters]
+        cfg.emr = [cluster for cluster in result if cluster]
     except Exception, e:
         LOG.info('Unable to list EMR clusters using IAM role "%s"' % role)
     return cfg
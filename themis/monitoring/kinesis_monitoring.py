@@ -231,18 +231,22 @@ def init_kinesis_config(run_parallel=False, role=None):
     cfg = themis.model.resources_model.ResourcesConfiguration()
 
     def init_kinesis_stream_config(stream_name):
-        stream_config = retrieve_stream_details(stream_name, role=role)
-        cfg.kinesis.append(stream_config)
+        try:
+            return retrieve_stream_details(stream_name, role=role)
+        except Exception, e:
+            # do not drop the other streams of the role if the details of one stream cannot be loaded
+            LOG.warning('Unable to get details for Kinesis stream %s: %s' % (stream_name, e))
+            return None
 
     # load Kinesis streams
     kinesis_client = aws_common.connect_kinesis(role=role)
     try:
         out = kinesis_client.list_streams()
         if run_parallel:
-            common.parallelize(out['StreamNames'], init_kinesis_stream_config)
+            result = common.parallelize(out['StreamNames'], init_kinesis_stream_config)
         else:
-            for c in out['StreamNames']:
-                init_kinesis_stream_config(c)
+            result = [init_kinesis_stream_config(c) for c in out['StreamNames']]
+        cfg.kinesis = [stream for stream in result if stream]
     except Exception, e:
         LOG.info('Unable to list Kinesis streams using IAM role "%s"' % role)
     return cfg
@@ -0,0 +1,138 @@
+import copy
+import time
+import threading
+import traceback
+from themis import config
+from themis.constants import *
+from themis.util import common
+from themis.monitoring import resources, snapshots
+
+# logger
+LOG = common.get_logger(__name__)
+
+# seconds between checks for resources whose monitoring data is due to be refreshed
+PREFETCH_TICK_SECS = 5
+
+# global prefetcher instance
+PREFETCHER = None
+mutex_prefetcher = threading.Lock()
+
+
+class MonitoringPrefetcher(object):
+    """
+    Keeps the monitoring data of all auto-scaled resources fresh in the background, each on
+    its own cadence (see config "prefetch_interval"). The collected data is published to the
+    snapshot store, from which the scaling loop reads it instead of collecting it inline.
+    Collections are shared with the scaling loop (see resources.submit_fetch), i.e., at most
+    one collection per resource is in progress at any time.
+    """
+
+    def __init__(self):
+        self.next_fetch = {}
+        self.consumed = {}
+        self.running = False
+        self.thread = None
+        self.mutex = threading.Lock()
+
+    def start(self):
+        with self.mutex:
+            self.running = True
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            LOG.info('Started background prefetching of monitoring data')
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            try:
+                self.prefetch()
+            except Exception, e:
+                LOG.warning('Error prefetching monitoring data: %s' % traceback.format_exc(e))
+            time.sleep(PREFETCH_TICK_SECS)
+
+    def prefetch(self, resource_list=None):
+        """ Submit a collection task to the worker pool for each auto-scaled resource that is due. """
+        if resource_list is None:
+            resource_list = resources.get_resources()
+        time_now = common.now()
+        for resource in resource_list:
+            if not resource.needs_scaling():
+                continue
+            key = (resources.get_section(resource), resource.id)
+            if self.next_fetch.get(key, 0) > time_now:
+                continue
+            # fetch_data(..) publishes the collected data to the snapshot store
+            task, submitted = resources.submit_fetch(resource)
+            if submitted:
+                self.next_fetch[key] = time_now + get_prefetch_interval(resource)
+
+    def take_snapshots(self, resource_list, timeout=MONITORING_TIMEOUT_SECS, max_age=None):
+        """
+        Apply the latest snapshot to each resource which has not been used for scaling yet and is
+        at most max_age seconds old (default: the prefetch interval plus timeout). For resources
+        without such a snapshot whose collection is in progress, wait up to timeout seconds for
+        the collection to finish. Returns the resources with applied snapshots, and the remaining
+        resources.
+        """
+        ready, pending = self.apply_snapshots(resource_list, max_age, timeout)
+        in_flight = [(resource, resources.get_fetch_task(resource)) for resource in pending]
+        in_flight = [(resource, task) for resource, task in in_flight if task]
+        if not in_flight:
+            return ready, pending
+        for resource, task in in_flight:
+            try:
+                task.get(timeout)
+            except Exception, e:
+                LOG.info('Unable to fetch monitoring data of resource %s: %s' % (resource.id, e))
+        ready_after_wait, pending = self.apply_snapshots(pending, max_age, timeout)
+        return ready + ready_after_wait, pending
+
+    def apply_snapshots(self, resource_list, max_age, timeout):
+        store = snapshots.get_snapshot_store()
+        ready = []
+        pending = []
+        for resource in resource_list:
+            section = resources.get_section(resource)
+            resource_max_age = max_age
+            if resource_max_age is None:
+                resource_max_age = get_prefetch_interval(resource) + timeout
+            snapshot = store.get(section, resource.id, max_age=resource_max_age)
+            if snapshot and snapshot.version > self.consumed.get((section, resource.id), 0):
+                # scaling modifies the monitoring data, hence use a copy
+                resource.monitoring_data = copy.deepcopy(snapshot.data)
+                self.consumed[(section, resource.id)] = snapshot.version
+                ready.append(resource)
+            else:
+                pending.append(resource)
+        return ready, pending
+
+    def set_consumed(self, resource_list):
+        """ Mark the current snapshots of the given resources as used, e.g., after collecting them inline. """
+        store = snapshots.get_snapshot_store()
+        for resource in resource_list:
+            section = resources.get_section(resource)
+            snapshot = store.get(section, resource.id)
+            if snapshot:
+                self.consumed[(section, resource.id)] = snapshot.version
+
+
+def get_prefetch_interval(resource):
+    default = PREFETCH_INTERVAL_EMR_SECS
+    section = resources.get_section(resource)
+    if section == config.SECTION_KINESIS:
+        default = PREFETCH_INTERVAL_KINESIS_SECS
+    return float(config.get_value(KEY_PREFETCH_INTERVAL, section=section, resource=resource.id, default=default))
+
+
+def get_prefetcher():
+    global PREFETCHER
+    if not PREFETCHER:
+        with mutex_prefetcher:
+            if not PREFETCHER:
+                PREFETCHER = MonitoringPrefetcher()
+    return PREFETCHER
@@ -1,14 +1,26 @@
 import re
+import threading
 from themis import config
 from themis.config import *
 from themis.util import aws_common
 from themis.util.common import *
+from themis.util.exceptions import TaskTimeoutException
 from themis.model.aws_model import *
 from themis.model.emr_model import *
 from themis.model.kinesis_model import *
 import themis.model.resources_model
+import themis.model.emr_model
+import themis.model.kinesis_model
 import themis.monitoring.kinesis_monitoring
 import themis.monitoring.emr_monitoring
+import themis.monitoring.snapshots
+
+# in-flight collections of monitoring data, keyed by (section, resource ID)
+FETCH_TASKS = {}
+FETCH_TASKS_LOCK = threading.Lock()
+
+# guards the initialization and loading of the resources file
+RESOURCES_LOCK = threading.RLock()
 
 
 def update_config(old_config, new_config, section, resource=None):
@@ -34,15 +46,18 @@ def update_resources(section=None):
 
 
 def get_resources(section=None, reload=False):
-    if reload and os.path.isfile(RESOURCES_FILE_LOCATION):
-        os.remove(RESOURCES_FILE_LOCATION)
-    reloaded = False
-    if not os.path.isfile(RESOURCES_FILE_LOCATION):
-        init_resources_file()
-        reloaded = True
-    config = load_resources_config()
-    if reloaded:
-        config = update_resources(section)
+    # callers in other threads (e.g., the prefetcher) must not read the file while it is initialized
+    with RESOURCES_LOCK:
+        if reload and os.path.isfile(RESOURCES_FILE_LOCATION):
+            os.remove(RESOURCES_FILE_LOCATION)
+        reloaded = False
+        if not os.path.isfile(RESOURCES_FILE_LOCATION):
+            init_resources_file()
+            reloaded = True
+        config = load_resources_config()
+        if reloaded:
+            config = update_resources(section)
+            remove_stale_snapshots(config.get_all())
     if not section:
         return config.get_all()
     return config.get(section)
@@ -61,6 +76,70 @@ def get_resource(section, resource_id, reload=False):
     return None
 
 
+def remove_stale_snapshots(resource_list):
+    """ Remove the monitoring data snapshots of resources which are not in the given list (anymore). """
+    store = themis.monitoring.snapshots.get_snapshot_store()
+    current = set((get_section(resource), resource.id) for resource in resource_list)
+    for section, resource_id in list(store.snapshots.keys()):
+        if (section, resource_id) not in current:
+            store.remove(section, resource_id)
+
+
+def get_section(resource):
+    if isinstance(resource, themis.model.emr_model.EmrCluster):
+        return SECTION_EMR
+    if isinstance(resource, themis.model.kinesis_model.KinesisStream):
+        return SECTION_KINESIS
+    return None
+
+
+def get_fetch_task(resource):
+    """ Return the in-flight collection task of the given resource, or None. """
+    with FETCH_TASKS_LOCK:
+        task = FETCH_TASKS.get((get_section(resource), resource.id))
+    return task if task and not task.done.is_set() else None
+
+
+def submit_fetch(resource):
+    """
+    Submit the collection of the monitoring data of a resource to the shared worker pool, unless a
+    previous collection for the resource is still running. Returns a tuple (task, submitted).
+    """
+    key = (get_section(resource), resource.id)
+    with FETCH_TASKS_LOCK:
+        task = FETCH_TASKS.get(key)
+        if task and not task.done.is_set():
+            return task, False
+        task = FETCH_TASKS[key] = common.get_worker_pool().submit(resource.fetch_data)
+        return task, True
+
+
+def fetch_all(resource_list, timeout=None):
+    """
+    Fetch the monitoring data of all given resources concurrently in the shared worker
+    pool. Returns the list of resources whose data was fetched successfully within the
+    given per-resource deadline (in seconds), in the order of the input list. Resources
+    whose previous collection is still running (e.g., after a timeout) are skipped.
+    """
+    tasks = []
+    for resource in resource_list:
+        task, submitted = submit_fetch(resource)
+        if not submitted:
+            LOG.warning('Skipping resource %s, previous collection of monitoring data still running' % resource.id)
+            continue
+        tasks.append((resource, task))
+    result = []
+    for resource, task in tasks:
+        try:
+            task.get(timeout)
+            result.append(resource)
+        except TaskTimeoutException, e:
+            LOG.warning('Timeout fetching monitoring data for resource %s after %s seconds' % (resource.id, timeout))
+        except Exception, e:
+            LOG.warning('Unable to fetch monitoring data for resource %s: %s' % (resource.id, e))
+    return result
+
+
 def load_resources_config():
     content = load_json_file(RESOURCES_FILE_LOCATION)
     cfg = themis.model.resources_model.ResourcesConfiguration.from_dict(content)
@@ -80,7 +159,7 @@ def save_resource(section, resource):
     save_resources_file(config)
 
 
-def init_resources_file(run_parallel=False):
+def init_resources_file(run_parallel=True):
     if os.path.isfile(RESOURCES_FILE_LOCATION):
         return
 
@@ -90,12 +169,21 @@ def init_resources_file(run_parallel=False):
     cfg = themis.model.resources_model.ResourcesConfiguration()
     LOG.info("Initializing config file with list of resources from AWS: %s" % RESOURCES_FILE_LOCATION)
 
-    for role in roles:
-        # load resources
+    def load_resources(role):
         kinesis_streams = themis.monitoring.kinesis_monitoring.init_kinesis_config(
             run_parallel=run_parallel, role=role).kinesis
         emr_clusters = themis.monitoring.emr_monitoring.init_emr_config(
             run_parallel=run_parallel, role=role).emr
+        return kinesis_streams, emr_clusters
+
+    # load resources of all roles (concurrently, in the bounded worker pool)
+    if run_parallel:
+        # do not write an incomplete resources file if loading the resources of a role fails
+        role_resources = common.parallelize(roles, load_resources, raise_errors=True)
+    else:
+        role_resources = [load_resources(role) for role in roles]
+
+    for role, (kinesis_streams, emr_clusters) in zip(roles, role_resources):
         for stream in kinesis_streams:
             cfg.kinesis.append(stream)
             config.set_value('role_to_assume', role, section=SECTION_KINESIS, resource=stream.id)
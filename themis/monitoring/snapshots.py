@@ -0,0 +1,93 @@
+import copy
+import threading
+from themis.util import common
+
+# logger
+LOG = common.get_logger(__name__)
+
+# global snapshot store instance
+SNAPSHOT_STORE = None
+mutex_store = threading.Lock()
+
+
+class Snapshot(object):
+    """ Monitoring data of a resource at a certain point in time. Must be treated as read-only. """
+
+    def __init__(self, section, resource_id, data, version, timestamp):
+        self.section = section
+        self.resource_id = resource_id
+        self.data = data
+        self.version = version
+        self.timestamp = timestamp
+
+    def age(self):
+        return max(common.now() - self.timestamp, 0)
+
+
+class SnapshotStore(object):
+    """
+    Keeps the latest monitoring data snapshot of each resource, published by the scaling
+    loop, so that readers (e.g., API requests) do not need to collect the data themselves.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        self.collect_locks = {}
+        self.mutex = threading.Lock()
+
+    def publish(self, section, resource_id, data, timestamp=None):
+        # store a copy, as the scaling logic modifies the monitoring data it operates on
+        data = copy.deepcopy(data)
+        timestamp = common.now() if timestamp is None else timestamp
+        with self.mutex:
+            key = (section, resource_id)
+            previous = self.snapshots.get(key)
+            version = previous.version + 1 if previous else 1
+            snapshot = self.snapshots[key] = Snapshot(section, resource_id, data, version, timestamp)
+        return snapshot
+
+    def get(self, section, resource_id, max_age=None):
+        """ Return the latest snapshot of a resource, or None if none exists that is at most max_age seconds old. """
+        snapshot = self.snapshots.get((section, resource_id))
+        if snapshot and (max_age is None or snapshot.age() <= max_age):
+            return snapshot
+        return None
+
+    def get_or_collect(self, section, resource_id, collect_func, max_age=None):
+        """
+        Return the latest snapshot of a resource if it is at most max_age seconds old, otherwise
+        collect and publish fresh data via collect_func(). Concurrent callers for the same
+        resource wait for a single collection instead of collecting the data themselves.
+        """
+        snapshot = self.get(section, resource_id, max_age)
+        if snapshot:
+            return snapshot
+        with self.mutex:
+            lock = self.collect_locks.setdefault((section, resource_id), threading.Lock())
+        with lock:
+            # re-check, the data may have been collected while we were waiting
+            snapshot = self.get(section, resource_id, max_age)
+            if snapshot:
+                return snapshot
+            data = collect_func()
+            if not data:
+                # do not publish the result of failed collections
+                return Snapshot(section, resource_id, data, 0, common.now())
+            return self.publish(section, resource_id, data)
+
+    def remove(self, section, resource_id):
+        with self.mutex:
+            self.snapshots.pop((section, resource_id), None)
+
+
+def get_snapshot_store():
+    global SNAPSHOT_STORE
+    if not SNAPSHOT_STORE:
+        with mutex_store:
+            if not SNAPSHOT_STORE:
+                SNAPSHOT_STORE = SnapshotStore()
+    return SNAPSHOT_STORE
+
+
+def publish(section, resource_id, data):
+    return get_snapshot_store().publish(section, resource_id, data)
@@ -76,13 +76,14 @@ def get_termination_candidates_for_market_or_group(info, preferred, instance_gro
     cluster_id = info['cluster_id']
     LOG.debug('cluster_id={}'.format(json.dumps(cluster_id)))
     role = emr_monitoring.get_iam_role_for_cluster(cluster_id)
+    groups = aws_common.get_instance_group_index(cluster_id, role=role)
     for key, details in info['nodes'].iteritems():
         if details['type'] == instance_group_type:
             if 'queries' not in details:
                 details['queries'] = 0
             # terminate only nodes with 0 queries running
             if details['queries'] == 0:
-                group_details = aws_common.get_instance_group_details(cluster_id, details['gid'], role=role)
+                group_details = groups.get(details['gid'])
                 if preferred in [group_details['Market'], group_details['id']]:
                     candidates.append(details)
     return candidates
@@ -185,19 +186,25 @@ def get_nodes_to_add(info, config=None):
 
 
 def terminate_node(cluster, node, config=None):
+    terminate_nodes(cluster, [node], config=config)
+
+
+def terminate_nodes(cluster, nodes, config=None):
+    """
+    Terminate the given nodes of a cluster, with one request per instance group. For Presto clusters
+    with "send_shutdown_signal" enabled, the shutdown signal is sent to all nodes in one batch instead.
+    """
     if not config:
         config = themis.config.get_config()
-    node_ip = node['ip']
-    instance_id = node['iid']
-    tasknodes_group = node['gid']
     shutdown_signal = config.get(SECTION_EMR, cluster.id, KEY_SEND_SHUTDOWN_SIGNAL)
     if aws_common.is_presto_cluster(cluster) and shutdown_signal == 'true':
-        LOG.info("Sending shutdown signal to Presto task node with IP '%s'" % node_ip)
-        aws_common.set_presto_node_state(cluster.ip, node_ip, aws_common.PRESTO_STATE_SHUTTING_DOWN)
+        node_ips = [node['ip'] for node in nodes]
+        LOG.info("Sending shutdown signal to Presto task nodes with IPs %s" % node_ips)
+        aws_common.set_presto_node_states(cluster.ip, node_ips, aws_common.PRESTO_STATE_SHUTTING_DOWN)
     else:
-        LOG.info("Terminating task node with instance ID '%s' in group '%s'" % (instance_id, tasknodes_group))
+        LOG.info("Terminating task nodes with instance IDs %s" % [node['iid'] for node in nodes])
         role = emr_monitoring.get_iam_role_for_cluster(cluster)
-        aws_common.terminate_task_node(instance_group_id=tasknodes_group, instance_id=instance_id, role=role)
+        aws_common.terminate_nodes(nodes, role=role)
 
 
 def spawn_nodes(cluster_ip, tasknodes_group, current_num_nodes, nodes_to_add=1, role=None):
@@ -212,10 +219,14 @@ def select_tasknode_group(tasknodes_groups, cluster_id, info=None):
         return tasknodes_groups[0]
     preferred_list = get_node_groups_or_preferred_markets(cluster_id, info=info)
     LOG.info('List of preferred TASK node groups: %s' % preferred_list)
+    # index groups by market and ID, the first group in the list wins
+    groups_by_key = {}
+    for group in tasknodes_groups:
+        groups_by_key.setdefault(group['Market'], group)
+        groups_by_key.setdefault(group['id'], group)
     for preferred in preferred_list:
-        for group in tasknodes_groups:
-            if preferred in [group['Market'], group['id']]:
-                return group
+        if preferred in groups_by_key:
+            return groups_by_key[preferred]
     raise Exception("Could not select task node instance group for preferred market %s: %s" %
                     (preferred_list, tasknodes_groups))
 
@@ -254,8 +265,7 @@ def perform_scaling(cluster):
             try:
                 nodes_to_terminate = get_nodes_to_terminate(info)
                 if len(nodes_to_terminate) > 0:
-                    for node in nodes_to_terminate:
-                        terminate_node(cluster, node, config=app_config)
+                    terminate_nodes(cluster, nodes_to_terminate, config=app_config)
                     action = 'DOWNSCALE(-%s)' % len(nodes_to_terminate)
                 else:
                     nodes_to_add = get_nodes_to_add(info)
@@ -7,23 +7,46 @@ import traceback
 import themis
 from themis import config
 from themis.constants import *
-from themis.util import common, aws_common, aws_pricing
+from themis.util import common, aws_common, aws_pricing, remote
 from themis.model.emr_model import *
 from themis.scaling import emr_scaling
-from themis.monitoring import resources
+from themis.monitoring import resources, prefetcher
 
 # logger
 LOG = common.get_logger(__name__)
 
 
 def loop():
+    try:
+        # add the SSH keys to the agent once, before the first remote command
+        remote.load_ssh_keys()
+    except Exception, e:
+        LOG.warning("Unable to load SSH keys: %s" % e)
     while True:
         LOG.info("Running next loop iteration")
         try:
+            pool_size = int(config.get_value(KEY_WORKER_POOL_SIZE, default=common.WORKER_POOL_SIZE))
+            common.get_worker_pool().set_max_workers(pool_size)
+            if aws_common.get_configured_roles():
+                # renew the sessions of the configured roles in the background, ahead of their expiry
+                aws_common.get_credential_manager().start()
             resource_list = resources.get_resources()
+            timeout = int(config.get_value(KEY_MONITORING_TIMEOUT, default=MONITORING_TIMEOUT_SECS))
 
-            for resource in resource_list:
-                resource.fetch_data()
+            # use the data collected in the background where available, collect the data of the
+            # remaining resources concurrently, then scale the resources whose data is available
+            ready = []
+            background = prefetcher.get_prefetcher()
+            if config.get_value(KEY_MONITORING_PREFETCH, default='true') == 'true':
+                background.start()
+                # do not base scaling decisions on data older than one loop interval
+                max_age = int(config.get_value(KEY_LOOP_INTERVAL_SECS))
+                ready, resource_list = background.take_snapshots(resource_list, timeout=timeout, max_age=max_age)
+            else:
+                background.stop()
+            fetched = resources.fetch_all(resource_list, timeout=timeout)
+            background.set_consumed(fetched)
+            for resource in ready + fetched:
                 scaling_required = resource.needs_scaling()
                 if scaling_required:
                     resource.perform_scaling(scaling_required)
@@ -4,12 +4,17 @@ import logging
 import boto3
 import os
 import pytz
+import time
+import calendar
+import threading
+import traceback
 from datetime import datetime
 from themis import config, constants
 from themis.config import SECTION_EMR
+from themis.util import common
 from themis.util.common import run_func, remove_lines_from_string, get_logger, short_uid, is_ip_address
 from themis.util.common import CURL_CONNECT_TIMEOUT, STATIC_INFO_CACHE_TIMEOUT, QUERY_CACHE_TIMEOUT
-from themis.util.remote import run_ssh
+from themis.util.remote import run_ssh, run_ssh_batch
 
 # constants
 
@@ -40,9 +45,28 @@ INITIAL_BOTO3_SESSION = None
 # Map role ARNs to sessions with assumed roles
 ASSUMED_ROLE_SESSIONS = {}
 
+# Cache of boto3 clients, keyed by (service, role ARN, endpoint URL)
+BOTO3_CLIENTS = {}
+BOTO3_CLIENTS_LOCK = threading.Lock()
+BOTO3_CLIENTS_STATS = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+# In-memory indexes of the instance groups of each cluster, keyed by cluster ID
+INSTANCE_GROUP_INDEXES = {}
+INSTANCE_GROUP_INDEXES_LOCK = threading.Lock()
+
 # Timespan before expiry to renew session
 SESSION_EXPIRY_RENEW_PERIOD = 10 * 60
 
+# Minimum remaining validity of a session to be handed out without renewing it first
+SESSION_MIN_VALIDITY = 60
+
+# Seconds between background checks for sessions which are due to be renewed
+SESSION_REFRESH_INTERVAL = 60
+
+# Global credential manager instance
+CREDENTIAL_MANAGER = None
+mutex_credentials = threading.Lock()
+
 # logger
 LOG = get_logger(__name__)
 
@@ -56,15 +80,120 @@ class StsSession(object):
         if not self.role_arn:
             # work with default boto3 session
             return boto3
-        if not self.session or self.expires_soon():
-            # create a new boto3 session using assume-role
-            self.session = do_assume_role(self.role_arn)
+        # sessions are renewed in the background by the credential manager
+        self.session = get_credential_manager().get_session(self.role_arn)
         return self.session
 
     def expires_soon(self):
         return session_expires_soon(self.session)
 
 
+class CredentialManager(object):
+    """
+    Keeps the sessions of all assumed IAM roles valid by renewing them in the background before
+    they expire, so that the STS round trip does not delay monitoring or scaling calls. Cached
+    sessions are handed out without locking; a session is only renewed inline if it is missing
+    or about to expire (e.g., for a newly configured role, or if background renewal failed).
+    """
+
+    def __init__(self):
+        self.sessions = ASSUMED_ROLE_SESSIONS
+        self.refresh_locks = {}
+        self.stats = {'refreshes': 0, 'failures': 0, 'latency_last': 0, 'latency_max': 0, 'latency_total': 0}
+        self.running = False
+        self.thread = None
+        self.mutex = threading.Lock()
+
+    def start(self):
+        with self.mutex:
+            self.running = True
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            LOG.info('Started background renewal of assumed role sessions')
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            try:
+                self.refresh_all()
+            except Exception, e:
+                LOG.warning('Error renewing assumed role sessions: %s' % traceback.format_exc(e))
+            time.sleep(SESSION_REFRESH_INTERVAL)
+
+    def get_session(self, role_arn):
+        session = self.sessions.get(role_arn)
+        if session and session.expires_at - time.time() > SESSION_MIN_VALIDITY:
+            return session
+        self.start()
+        return self.refresh(role_arn, SESSION_MIN_VALIDITY)
+
+    def refresh(self, role_arn, renew_period=SESSION_EXPIRY_RENEW_PERIOD):
+        """ Renew the session of the given role, unless it is valid for more than renew_period seconds. """
+        with self.mutex:
+            lock = self.refresh_locks.setdefault(role_arn, threading.Lock())
+        with lock:
+            # re-check, the session may have been renewed while we were waiting
+            session = self.sessions.get(role_arn)
+            if session and session.expires_at - time.time() > renew_period:
+                return session
+            start_time = time.time()
+            try:
+                session = do_assume_role(role_arn)
+            except Exception, e:
+                with self.mutex:
+                    self.stats['failures'] += 1
+                raise
+            latency = time.time() - start_time
+            with self.mutex:
+                self.stats['refreshes'] += 1
+                self.stats['latency_last'] = latency
+                self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+                self.stats['latency_total'] += latency
+            LOG.debug('Renewed session for role %s in %.2f secs' % (role_arn, latency))
+            # replace the session atomically, readers keep using the previous session until then
+            self.sessions[role_arn] = session
+            return session
+
+    def refresh_all(self):
+        """ Renew the sessions of all configured and previously used roles which expire soon. """
+        roles = set(self.sessions.keys())
+        roles.update(get_configured_roles())
+        for role_arn in roles:
+            try:
+                self.refresh(role_arn)
+            except Exception, e:
+                LOG.warning('Unable to renew session for role %s: %s' % (role_arn, e))
+
+    def get_stats(self):
+        with self.mutex:
+            result = dict(self.stats)
+        latency_total = result.pop('latency_total')
+        result['latency_avg'] = latency_total / result['refreshes'] if result['refreshes'] else 0
+        time_now = time.time()
+        result['sessions'] = dict((role_arn, {'expires_in': int(session.expires_at - time_now)})
+            for role_arn, session in self.sessions.items())
+        return result
+
+
+def get_credential_manager():
+    global CREDENTIAL_MANAGER
+    if not CREDENTIAL_MANAGER:
+        with mutex_credentials:
+            if not CREDENTIAL_MANAGER:
+                CREDENTIAL_MANAGER = CredentialManager()
+    return CREDENTIAL_MANAGER
+
+
+def get_configured_roles():
+    roles = config.get_config().general.roles_to_assume
+    return [role for role in re.split(r'\s*,\s*', roles or '') if role]
+
+
 def session_expires_soon(session):
     exp = session.expiration
     now = datetime.now()
@@ -105,7 +234,26 @@ def connect_to_service(service, session=None, role=None):
     session = session if session else assume_role(role) if role else None
     endpoint_url = TEST_ENDPOINTS.get(service)
     boto3_session = session.get() if session else boto3
-    return boto3_session.client(service, endpoint_url=endpoint_url)
+    key = (service, getattr(session, 'role_arn', None), endpoint_url)
+    with BOTO3_CLIENTS_LOCK:
+        cached = BOTO3_CLIENTS.get(key)
+        # clients are bound to the credentials of their session, hence re-create them after session renewal
+        if cached and cached[0] is boto3_session:
+            BOTO3_CLIENTS_STATS['hits'] += 1
+            return cached[1]
+        if cached:
+            BOTO3_CLIENTS_STATS['invalidations'] += 1
+        BOTO3_CLIENTS_STATS['misses'] += 1
+        client = boto3_session.client(service, endpoint_url=endpoint_url)
+        BOTO3_CLIENTS[key] = (boto3_session, client)
+        return client
+
+
+def get_client_cache_stats():
+    with BOTO3_CLIENTS_LOCK:
+        result = dict(BOTO3_CLIENTS_STATS)
+        result['size'] = len(BOTO3_CLIENTS)
+    return result
 
 
 def assume_role(role_arn):
@@ -113,28 +261,32 @@ def assume_role(role_arn):
 
 
 def do_assume_role(role_arn):
-    session = ASSUMED_ROLE_SESSIONS.get(role_arn)
-    if not session or session_expires_soon(session):
-        global INITIAL_BOTO3_SESSION
-        # save initial session with micros credentials to use for assuming role
-        if not INITIAL_BOTO3_SESSION:
-            INITIAL_BOTO3_SESSION = boto3.session.Session()
-        client = INITIAL_BOTO3_SESSION.client('sts')
-        # generate a random role session name
-        role_session_name = 's-' + str(short_uid())
-        # make API call to assume role
-        response = client.assume_role(RoleArn=role_arn, RoleSessionName=role_session_name)
-        # save session with new credentials to use for all aws calls
-        session = boto3.session.Session(
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken'])
-        session.expiration = response['Credentials']['Expiration']
-        # store session for future reference
-        ASSUMED_ROLE_SESSIONS[role_arn] = session
+    """ Create a new session for the given role. Use get_credential_manager() to obtain cached sessions. """
+    global INITIAL_BOTO3_SESSION
+    # save initial session with micros credentials to use for assuming role
+    if not INITIAL_BOTO3_SESSION:
+        INITIAL_BOTO3_SESSION = boto3.session.Session()
+    client = INITIAL_BOTO3_SESSION.client('sts')
+    # generate a random role session name
+    role_session_name = 's-' + str(short_uid())
+    # make API call to assume role
+    response = client.assume_role(RoleArn=role_arn, RoleSessionName=role_session_name)
+    # save session with new credentials to use for all aws calls
+    session = boto3.session.Session(
+        aws_access_key_id=response['Credentials']['AccessKeyId'],
+        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
+        aws_session_token=response['Credentials']['SessionToken'])
+    session.expiration = response['Credentials']['Expiration']
+    session.expires_at = get_expiry_timestamp(session.expiration)
     return session
 
 
+def get_expiry_timestamp(expiration):
+    if expiration.tzinfo:
+        return calendar.timegm(expiration.utctimetuple())
+    return time.mktime(expiration.timetuple())
+
+
 def ip_to_hostname(ip, domain_name):
     return 'ip-' + re.sub(r'\.', r'-', ip) + '.' + domain_name
 
@@ -158,7 +310,6 @@ def get_instance_by_ip(ip, role=None):
     result = run_func(ec2_client.describe_instances,
                       Filters=[{'Name': 'private-ip-address', 'Values': [ip]}],
                       cache_duration_secs=STATIC_INFO_CACHE_TIMEOUT)
-    result = json.loads(result)
     return result['Reservations'][0]['Instances'][0]
 
 
@@ -166,9 +317,10 @@ def get_instance_groups(cluster_id, role=None):
     emr_client = connect_emr(role=role)
     result = run_func(emr_client.list_instance_groups, ClusterId=cluster_id,
                       cache_duration_secs=QUERY_CACHE_TIMEOUT)
-    result = json.loads(result)
     result_map = {}
     for group in result['InstanceGroups']:
+        # copy, as the cached result is shared
+        group = dict(group)
         group_type = group['InstanceGroupType']
         if group_type not in result_map:
             result_map[group_type] = []
@@ -179,17 +331,49 @@ def get_instance_groups(cluster_id, role=None):
     return result_map
 
 
+class InstanceGroupIndex(object):
+    """ In-memory index of the instance groups of a cluster, by group type and group ID. """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.by_id = {}
+        for group_type, arr in groups.iteritems():
+            for group in arr:
+                self.by_id[group['id']] = group
+        self.timestamp = common.now()
+
+    def get(self, group_id):
+        return self.by_id.get(group_id)
+
+    def get_groups(self, group_type):
+        return self.groups[group_type]
+
+
+def get_instance_group_index(cluster_id, role=None, refresh=False):
+    """
+    Return the instance group index of a cluster. The index is re-built if it is older
+    than QUERY_CACHE_TIMEOUT, or if refresh is True (e.g., once per monitoring run).
+    """
+    with INSTANCE_GROUP_INDEXES_LOCK:
+        index = INSTANCE_GROUP_INDEXES.get(cluster_id)
+    if index and not refresh and common.now() - index.timestamp < common.QUERY_CACHE_TIMEOUT:
+        return index
+    index = InstanceGroupIndex(get_instance_groups(cluster_id, role=role))
+    with INSTANCE_GROUP_INDEXES_LOCK:
+        INSTANCE_GROUP_INDEXES[cluster_id] = index
+    return index
+
+
 def get_instance_groups_tasknodes(cluster_id, role=None):
-    return get_instance_groups(cluster_id, role=role)[INSTANCE_GROUP_TYPE_TASK]
+    return get_instance_group_index(cluster_id, role=role).get_groups(INSTANCE_GROUP_TYPE_TASK)
 
 
 def get_instance_groups_nodes(cluster_id, role=None, instance_group_type=INSTANCE_GROUP_TYPE_CORE):
-    return get_instance_groups(cluster_id, role=role)[instance_group_type]
+    return get_instance_group_index(cluster_id, role=role).get_groups(instance_group_type)
 
 
 def get_instance_groups_ids(cluster_id, group_type, role=None):
-    groups = get_instance_groups(cluster_id, role=role)
-    return groups[group_type]
+    return get_instance_group_index(cluster_id, role=role).get_groups(group_type)
 
 
 def get_instance_group_type(cluster_id, group_id, role=None):
@@ -197,12 +381,7 @@ def get_instance_group_type(cluster_id, group_id, role=None):
 
 
 def get_instance_group_details(cluster_id, group_id, role=None):
-    groups = get_instance_groups(cluster_id, role=role)
-    for key, arr in groups.iteritems():
-        for val in arr:
-            if val['id'] == group_id:
-                return val
-    return None
+    return get_instance_group_index(cluster_id, role=role).get(group_id)
 
 
 def get_instance_group_for_node(cluster_id, node_host, role=None):
@@ -218,12 +397,13 @@ def get_cluster_nodes(cluster_id, role=None):
     result = run_func(emr_client.list_instances, ClusterId=cluster_id,
                       InstanceStates=['AWAITING_FULFILLMENT', 'PROVISIONING', 'BOOTSTRAPPING', 'RUNNING'],
                       cache_duration_secs=QUERY_CACHE_TIMEOUT)
-    result = json.loads(result)
-    result = result['Instances']
+    # copy the instances, as the cached result is shared and the instances are modified below
+    result = [dict(inst) for inst in result['Instances']]
 
     # read domain name config
     custom_dn = config.get_value(constants.KEY_CUSTOM_DOMAIN_NAME, section=SECTION_EMR, resource=cluster_id)
 
+    groups = get_instance_group_index(cluster_id, role=role)
     i = 0
     while i < len(result):
         inst = result[i]
@@ -238,9 +418,10 @@ def get_cluster_nodes(cluster_id, role=None):
             inst['host'] = inst['PrivateDnsName'] if 'PrivateDnsName' in inst else 'n/a'
             if custom_dn:
                 inst['host'] = ip_to_hostname(hostname_to_ip(inst['host']), custom_dn)
-            inst['type'] = get_instance_group_type(cluster_id, inst['InstanceGroupId'], role=role)
+            group = groups.get(inst['InstanceGroupId'])
+            inst['type'] = group['type']
             inst['state'] = inst['Status']['State']
-            inst['market'] = get_instance_group_details(cluster_id, inst['InstanceGroupId'], role=role)['Market']
+            inst['market'] = group['Market']
         i += 1
     return result
 
@@ -252,15 +433,31 @@ def get_all_task_nodes(cluster_id, cluster_ip, role=None):
 
 
 def terminate_task_node(instance_group_id, instance_id, role=None):
-    # terminate instance
+    return terminate_task_nodes(instance_group_id, [instance_id], role=role)
+
+
+def terminate_task_nodes(instance_group_id, instance_ids, role=None):
+    # terminate instances
     emr_client = connect_emr(role=role)
-    LOG.info('Terminate instance %s of instance group %s' % (instance_id, instance_group_id))
+    LOG.info('Terminate instances %s of instance group %s' % (instance_ids, instance_group_id))
     result = emr_client.modify_instance_groups(InstanceGroups=[
-        {'InstanceGroupId': instance_group_id, 'EC2InstanceIdsToTerminate': [instance_id]}
+        {'InstanceGroupId': instance_group_id, 'EC2InstanceIdsToTerminate': list(instance_ids)}
     ])
     return result
 
 
+def terminate_nodes(nodes, role=None):
+    """ Terminate the instances of the given nodes, using a single request per instance group. """
+    instances_by_group = {}
+    for node in nodes:
+        instance_ids = instances_by_group.setdefault(node['gid'], [])
+        if node['iid'] not in instance_ids:
+            instance_ids.append(node['iid'])
+    for instance_group_id in sorted(instances_by_group.keys()):
+        terminate_task_nodes(instance_group_id, instances_by_group[instance_group_id], role=role)
+    return instances_by_group
+
+
 def spawn_task_node(instance_group_id, current_size, additional_nodes=1, role=None):
     # start new instance
     emr_client = connect_emr(role=role)
@@ -281,40 +478,94 @@ def terminate_inactive_nodes(cluster, cluster_state, role=None):
     if not is_presto_cluster(cluster):
         return
     nodes = cluster_state['nodes']
+    commands = {}
     for key, node in nodes.iteritems():
         if (node['state'] == INSTANCE_STATE_RUNNING and
                 node['presto_state'] not in [PRESTO_STATE_SHUTTING_DOWN, PRESTO_STATE_ACTIVE]):
-            try:
-                cmd = "cat /etc/presto/conf/config.properties | grep http-server.threads"
-                out = run_ssh(cmd, cluster.ip, user='hadoop',
-                              via_hosts=[node['host']], cache_duration_secs=QUERY_CACHE_TIMEOUT)
-                if INVALID_CONFIG_VALUE in out:
-                    LOG.info("Terminating instance of idle node %s in instance group %s" %
-                             (node['iid'], node['gid']))
-                    terminate_task_node(instance_group_id=node['gid'], instance_id=node['iid'], role=role)
-            except Exception, e:
-                LOG.info("Unable to read Presto config from node %s: %s" % (node, e))
+            commands[key] = ('cat /etc/presto/conf/config.properties | grep http-server.threads', node['host'])
+    if not commands:
+        return
+    try:
+        # check the config of all candidate nodes with a single SSH round trip to the master
+        results = run_ssh_batch(commands, cluster.ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
+    except Exception, e:
+        LOG.info("Unable to read Presto config from nodes of cluster %s: %s" % (cluster.id, e))
+        return
+    inactive_nodes = []
+    for key, result in results.iteritems():
+        node = nodes[key]
+        if result['code'] != 0:
+            LOG.info("Unable to read Presto config from node %s: %s" % (node, result['output']))
+        elif INVALID_CONFIG_VALUE in result['output']:
+            LOG.info("Terminating instance of idle node %s in instance group %s" % (node['iid'], node['gid']))
+            inactive_nodes.append(node)
+    if inactive_nodes:
+        terminate_nodes(inactive_nodes, role=role)
 
 
 def get_presto_node_state(cluster_ip, node_ip):
-    cmd = ('curl -s --connect-timeout %s --max-time %s http://%s:8889/v1/info/state' %
-           (CURL_CONNECT_TIMEOUT, CURL_CONNECT_TIMEOUT, node_ip))
-    out = run_ssh(cmd, cluster_ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
-    out = remove_lines_from_string(out, r'.*Permanently added.*')
-    out = re.sub(r'\s*"(.+)"\s*', r'\1', out)
-    return out
+    state = get_presto_node_states(cluster_ip, [node_ip])[node_ip]
+    if state is None:
+        raise Exception('Unable to get Presto state of node %s' % node_ip)
+    return state
+
+
+def get_presto_node_states(cluster_ip, node_ips):
+    """
+    Query the Presto state of the given nodes from the master, with a single SSH round trip.
+    Returns a map of node IPs to states (None for nodes whose state could not be queried).
+    """
+    commands = {}
+    for node_ip in node_ips:
+        commands[node_ip] = ('curl -s --connect-timeout %s --max-time %s http://%s:8889/v1/info/state' %
+                             (CURL_CONNECT_TIMEOUT, CURL_CONNECT_TIMEOUT, node_ip))
+    results = run_ssh_batch(commands, cluster_ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
+    return dict((node_ip, parse_presto_state(node_ip, result)) for node_ip, result in results.iteritems())
 
 
 def set_presto_node_state(cluster_ip, node_ip, state):
-    cmd = ("sudo sed -i 's/http-server.threads.max=.*/http-server.threads.max=%s/g' " +
-           "/etc/presto/conf/config.properties") % INVALID_CONFIG_VALUE
+    result = set_presto_node_states(cluster_ip, [node_ip], state)[node_ip]
+    if result is None:
+        raise Exception('Unable to set Presto state of node %s' % node_ip)
+    return result
+
+
+def set_presto_node_states(cluster_ip, node_ips, state):
+    """
+    Disable the HTTP server threads of the given nodes and set their Presto state, with two SSH round trips.
+    Only nodes whose config has been updated are sent the new state. Returns a map of node IPs to the
+    resulting states (None for nodes whose config or state could not be updated).
+    """
     if not is_ip_address(cluster_ip):
         cluster_ip = hostname_to_ip(cluster_ip)
-    out = run_ssh(cmd, cluster_ip, user='hadoop', via_hosts=[node_ip], cache_duration_secs=QUERY_CACHE_TIMEOUT)
-
-    cmd = ("curl -s --connect-timeout %s -X PUT -H 'Content-Type:application/json' " +
-           "-d '\\\"%s\\\"' http://%s:8889/v1/info/state") % (CURL_CONNECT_TIMEOUT, state, node_ip)
-    LOG.info(cmd)
-    out = run_ssh(cmd, cluster_ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
-    out = re.sub(r'\s*"(.+)"\s*', r'\1', out)
-    return out
+    cmd = ("sudo sed -i 's/http-server.threads.max=.*/http-server.threads.max=%s/g' " +
+           "/etc/presto/conf/config.properties") % INVALID_CONFIG_VALUE
+    commands = dict((node_ip, (cmd, node_ip)) for node_ip in node_ips)
+    results = run_ssh_batch(commands, cluster_ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
+    updated_ips = []
+    for node_ip in node_ips:
+        result = results[node_ip]
+        if result['code'] != 0:
+            LOG.warning('Unable to update Presto config of node %s: %s' % (node_ip, result['output']))
+        else:
+            updated_ips.append(node_ip)
+    states = dict((node_ip, None) for node_ip in node_ips)
+    if not updated_ips:
+        return states
+
+    commands = {}
+    for node_ip in updated_ips:
+        commands[node_ip] = ("curl -s --connect-timeout %s -X PUT -H 'Content-Type:application/json' " +
+                             "-d '\"%s\"' http://%s:8889/v1/info/state") % (CURL_CONNECT_TIMEOUT, state, node_ip)
+        LOG.info(commands[node_ip])
+    results = run_ssh_batch(commands, cluster_ip, user='hadoop', cache_duration_secs=QUERY_CACHE_TIMEOUT)
+    states.update((node_ip, parse_presto_state(node_ip, result)) for node_ip, result in results.iteritems())
+    return states
+
+
+def parse_presto_state(node_ip, result):
+    if result['code'] != 0:
+        LOG.debug('Unable to query Presto state of node %s: %s' % (node_ip, result['output']))
+        return None
+    out = remove_lines_from_string(result['output'], r'.*Permanently added.*')
+    return re.sub(r'\s*"(.+)"\s*', r'\1', out)
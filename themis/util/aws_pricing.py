@@ -14,6 +14,9 @@ LOCATION_NAMES = {
     'us-east-1': 'US East (N. Virginia)'
 }
 
+# timeout (secs) for downloading the (large) price list file
+PRICING_DOWNLOAD_TIMEOUT_SECS = 30 * 60
+
 LOG = get_logger(__name__)
 
 
@@ -66,7 +69,7 @@ def load_fixed_prices(zone):
         LOG.info("Downloading latest pricing information from AWS")
         try:
             cmd = "curl %s > %s" % (url, file)
-            run(cmd)
+            run(cmd, timeout=PRICING_DOWNLOAD_TIMEOUT_SECS)
         except Exception, e:
             raise ConnectivityException('Unable to get pricing information.')
         result = open(file).read()
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# logger
+LOG = logging.getLogger(__name__)
+
+
+class InFlight(object):
+    """ A computation of a cache value which is currently in progress. """
+
+    def __init__(self):
+        self.thread = threading.current_thread().ident
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def get(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class TTLCache(object):
+    """
+    Thread-safe in-memory cache of native Python objects. Entries expire based on the max. age
+    given by the reader, and the least recently used entries are evicted once the number of
+    entries exceeds max_entries, or their approximate size (length of their JSON encoding)
+    exceeds max_bytes. If disk_dir is given, entries are additionally written to JSON files in
+    that directory, which allows to warm up the cache after a restart. Values which cannot be
+    encoded as JSON (e.g., boto3 responses containing datetime values) are only kept in memory,
+    so that values restored from disk are equal to the originally cached values (except that
+    tuples become lists and strings become unicode strings).
+    """
+
+    def __init__(self, max_entries=2000, max_bytes=None, disk_dir=None, disk_max_age=60 * 60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_age = disk_max_age
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'disk_hits': 0, 'coalesced': 0,
+            'too_large': 0}
+        self.in_flight = {}
+        self.last_disk_clean = 0
+
+    def get(self, key, max_age):
+        """ Return a tuple (found, value) for the given key, considering only entries up to max_age seconds old. """
+        time_now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                if entry[0] > time_now - max_age:
+                    # re-insert to mark the entry as most recently used
+                    self.entries[key] = entry
+                    self.stats['hits'] += 1
+                    return True, entry[1]
+                self.total_bytes -= entry[2]
+                self.stats['expirations'] += 1
+        entry = self.read_from_disk(key)
+        if entry and entry[0] > time_now - max_age:
+            with self.lock:
+                self.stats['disk_hits'] += 1
+                self.store(key, entry)
+            return True, entry[1]
+        with self.lock:
+            self.stats['misses'] += 1
+        return False, None
+
+    def get_or_compute(self, key, max_age, func):
+        """
+        Return the cached value for the given key, or compute it via func() and cache it. Concurrent
+        callers with the same key wait for a single in-flight computation and share its result (or error).
+        """
+        found, value = self.get(key, max_age)
+        if found:
+            return value
+        current_thread = threading.current_thread().ident
+        with self.lock:
+            flight = self.in_flight.get(key)
+            is_owner = flight is None
+            if is_owner:
+                flight = self.in_flight[key] = InFlight()
+            elif flight.thread != current_thread:
+                self.stats['coalesced'] += 1
+        if not is_owner:
+            if flight.thread == current_thread:
+                # re-entrant call for the same key (e.g., a retry), compute the value directly
+                return func()
+            return flight.get()
+        try:
+            flight.result = func()
+            self.put(key, flight.result)
+            return flight.result
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.done.set()
+
+    def put(self, key, value):
+        timestamp = time.time()
+        try:
+            content = json.dumps({'timestamp': timestamp, 'value': value})
+            size = len(content)
+        except (TypeError, ValueError), e:
+            content = None
+            size = get_size(value)
+        with self.lock:
+            self.store(key, (timestamp, value, size))
+        if content is not None:
+            self.write_to_disk(key, content)
+
+    def store(self, key, entry):
+        old_entry = self.entries.pop(key, None)
+        if old_entry:
+            self.total_bytes -= old_entry[2]
+        if self.max_bytes and entry[2] > self.max_bytes:
+            self.stats['too_large'] += 1
+            return
+        self.entries[key] = entry
+        self.total_bytes += entry[2]
+        while len(self.entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted[2]
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            result = dict(self.stats)
+            result['entries'] = len(self.entries)
+            result['max_entries'] = self.max_entries
+            result['bytes'] = self.total_bytes
+            result['max_bytes'] = self.max_bytes
+        return result
+
+    def get_file(self, key):
+        return os.path.join(self.disk_dir, 'cache.%s.json' % hashlib.md5(key).hexdigest())
+
+    def read_from_disk(self, key):
+        if not self.disk_dir:
+            return None
+        cache_file = self.get_file(key)
+        if not os.path.isfile(cache_file):
+            return None
+        try:
+            with open(cache_file) as f:
+                content = f.read()
+            entry = json.loads(content)
+            return entry['timestamp'], entry['value'], len(content)
+        except Exception, e:
+            LOG.debug('Unable to read cache file %s: %s' % (cache_file, e))
+            return None
+
+    def write_to_disk(self, key, content):
+        if not self.disk_dir:
+            return
+        cache_file = self.get_file(key)
+        try:
+            tmp_file = '%s.%s.tmp' % (cache_file, threading.current_thread().ident)
+            with open(tmp_file, 'w') as f:
+                f.write(content)
+            os.rename(tmp_file, cache_file)
+        except Exception, e:
+            LOG.debug('Unable to write cache file %s: %s' % (cache_file, e))
+        self.clean_disk()
+
+    def clean_disk(self, interval=60 * 5):
+        time_now = time.time()
+        with self.lock:
+            if self.last_disk_clean > time_now - interval:
+                return
+            self.last_disk_clean = time_now
+        for cache_file in glob.glob(os.path.join(self.disk_dir, 'cache.*.json')):
+            try:
+                if os.path.getmtime(cache_file) < time_now - self.disk_max_age:
+                    os.remove(cache_file)
+            except OSError, e:
+                pass
+
+
+def get_size(value):
+    """ Get the approximate size of the given value in bytes, i.e., the length of its JSON encoding. """
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError), e:
+        return sys.getsizeof(value)
@@ -1,35 +1,74 @@
 import threading
+import traceback
+import Queue
 import subprocess32 as subprocess
 import os
 import re
 import time
+import signal
 import urllib
-import glob
 import json
 import math
 import uuid
 import logging
 import decimal
+import urlparse
+import requests
 import pyhive.presto
 from datetime import datetime, timedelta
 from collections import namedtuple
-
-CACHE_CLEAN_TIMEOUT = 60 * 5
+from themis.util.exceptions import TaskTimeoutException
+from themis.util.cache import TTLCache
+
+# maximum number of entries in the in-memory cache (least recently used entries are evicted)
+CACHE_MAX_ENTRIES = 5000
+# maximum approximate size (length of the JSON encoding) of all entries in the in-memory cache
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+# maximum age of cache files in the (optional) on-disk cache tier
 CACHE_MAX_AGE = 60 * 60
-CACHE_FILE_PATTERN = '/tmp/cache.*.json'
+# environment variable with the directory for the on-disk cache tier (disabled if not set)
+ENV_CACHE_DIR = 'THEMIS_CACHE_DIR'
 
 # connect timeout for curl commands
 CURL_CONNECT_TIMEOUT = 3
 
+# default timeouts and pool size for native HTTP requests
+HTTP_CONNECT_TIMEOUT = CURL_CONNECT_TIMEOUT
+HTTP_READ_TIMEOUT = 10
+HTTP_POOL_SIZE = 20
+
+# interval (seconds) for polling the results of Presto queries
+PRESTO_POLL_INTERVAL = 0.1
+
 # cache query results
 QUERY_CACHE_TIMEOUT = 60
 GANGLIA_CACHE_TIMEOUT = 60
 STATIC_INFO_CACHE_TIMEOUT = 60 * 30
 
-# cache globals
-last_cache_clean_time = 0
-mutex_clean = threading.RLock()
-mutex_popen = threading.RLock()
+# float values which cannot be represented in JSON, besides NaN
+INFINITY_VALUES = (float('Inf'), -float('Inf'))
+
+# default maximum number of worker threads in the shared worker pool
+WORKER_POOL_SIZE = 30
+
+# cache globals, see get_cache()
+CACHE = None
+mutex_cache = threading.RLock()
+
+# default timeout (secs) of commands executed via run(..)
+RUN_TIMEOUT_SECS = 10 * 60
+
+# maximum number of subprocesses executed concurrently via run(..)
+RUN_MAX_PROCESSES = 20
+PROCESS_SEMAPHORE = threading.BoundedSemaphore(RUN_MAX_PROCESSES)
+
+# pooled keep-alive HTTP sessions, keyed by target host
+HTTP_SESSIONS = {}
+mutex_http = threading.RLock()
+
+# shared worker pool, see get_worker_pool()
+WORKER_POOL = None
+mutex_pool = threading.RLock()
 
 
 def get_logger(name=None):
@@ -61,20 +100,14 @@ class FuncThread(threading.Thread):
             print("WARN: not implemented: FuncThread.stop(..)")
 
 
-def clean_cache():
-    global last_cache_clean_time
-    mutex_clean.acquire()
-    try:
-        time_now = now()
-        if last_cache_clean_time > time_now - CACHE_CLEAN_TIMEOUT:
-            return
-        for cache_file in set(glob.glob(CACHE_FILE_PATTERN)):
-            mod_time = os.path.getmtime(cache_file)
-            if time_now > mod_time + CACHE_MAX_AGE:
-                os.remove(cache_file)
-        last_cache_clean_time = time_now
-    finally:
-        mutex_clean.release()
+def get_cache():
+    global CACHE
+    if not CACHE:
+        with mutex_cache:
+            if not CACHE:
+                CACHE = TTLCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                    disk_dir=os.environ.get(ENV_CACHE_DIR), disk_max_age=CACHE_MAX_AGE)
+    return CACHE
 
 
 def setup_logging(log_file=None, format='%(asctime)s %(levelname)s: %(name)s: %(message)s'):
@@ -166,25 +199,26 @@ def is_ip_address(s):
 def is_NaN(obj, expect_only_numbers=False):
     if expect_only_numbers and not is_number(obj):
         return True
-    if obj == 'NaN' or (isinstance(obj, float) and
-            math.isnan(obj) or obj in [float('Inf'), -float('Inf')]):
+    if isinstance(obj, float):
+        return obj != obj or obj in INFINITY_VALUES
+    if obj == 'NaN' or obj in INFINITY_VALUES:
         return True
     return False
 
 
 def remove_NaN(obj, delete_values=True, replacement='NaN', expect_only_numbers=False):
     if isinstance(obj, list):
-        i = 0
-        while i < len(obj):
-            if is_composite(obj[i]):
-                remove_NaN(obj[i], delete_values, replacement, expect_only_numbers)
-            elif is_NaN(obj[i], expect_only_numbers):
+        result = []
+        for item in obj:
+            if is_composite(item):
+                remove_NaN(item, delete_values, replacement, expect_only_numbers)
+            elif is_NaN(item, expect_only_numbers):
                 if delete_values:
-                    del obj[i]
-                    i -= 1
-                else:
-                    obj[i] = replacement
-            i += 1
+                    continue
+                item = replacement
+            result.append(item)
+        # rebuild the list in place, instead of deleting single items
+        obj[:] = result
     elif isinstance(obj, dict):
         for key in list(obj.keys()):
             if is_composite(obj[key]):
@@ -197,6 +231,67 @@ def remove_NaN(obj, delete_values=True, replacement='NaN', expect_only_numbers=F
     return obj
 
 
+def json_key(key):
+    """ Convert the given dict key to a string, analogous to json.dumps(..) for non-string keys. """
+    if isinstance(key, basestring):
+        return key
+    if key is None:
+        return 'null'
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if isinstance(key, (int, long, float)):
+        return json.dumps(key)
+    converted = json_defaults(key)
+    if converted is key:
+        raise TypeError('key %r is not a string' % (key,))
+    return json_key(converted)
+
+
+def json_sanitize(obj, delete_values=True, replacement='NaN'):
+    """
+    Return a copy of the given object which can be encoded with json.dumps(..). NaN/Inf values
+    are deleted or replaced, analogous to remove_NaN(..), and non-string keys are converted via
+    json_key(..). The given object is not modified.
+    """
+    if isinstance(obj, dict):
+        result = {}
+        for key, value in obj.iteritems():
+            if isinstance(value, (dict, list, tuple)):
+                value = json_sanitize(value, delete_values, replacement)
+            elif is_NaN(value):
+                if delete_values:
+                    continue
+                value = replacement
+            if not isinstance(key, basestring):
+                key = json_key(key)
+            result[key] = value
+        return result
+    if isinstance(obj, (list, tuple)):
+        result = []
+        for item in obj:
+            if isinstance(item, (dict, list, tuple)):
+                item = json_sanitize(item, delete_values, replacement)
+            elif is_NaN(item):
+                if delete_values:
+                    continue
+                item = replacement
+            result.append(item)
+        return result
+    if is_NaN(obj):
+        return None if delete_values else replacement
+    return obj
+
+
+def json_dumps(obj, delete_values=True, replacement='NaN'):
+    """
+    Encode the given object as JSON, with NaN values handled as in json_sanitize(..). Decimal and
+    datetime values are converted via json_defaults(..).
+    """
+    return json.dumps(json_sanitize(obj, delete_values, replacement), default=json_defaults)
+
+
 def short_uid():
     return str(uuid.uuid4())[0:8]
 
@@ -228,60 +323,94 @@ def run_func(func, cache_duration_secs=0, **kwargs):
 
 
 def run_cached(func, cache_duration_secs=0, **kwargs):
+    """
+    Run the given function, or return its cached result if the function has been called with the
+    same arguments within the last cache_duration_secs seconds. Concurrent calls with the same
+    arguments are coalesced into a single execution. Results are cached as native objects and
+    shared between callers, i.e., callers must not modify them (or modify a copy).
+    """
     if cache_duration_secs <= 0:
         return func(**kwargs)
-    hash = md5(func.__name__ + str(kwargs))
-    cache_file = CACHE_FILE_PATTERN.replace('*', '%s') % hash
-    if os.path.isfile(cache_file):
-        # check file age
-        mod_time = os.path.getmtime(cache_file)
-        time_now = now()
-        if mod_time > (time_now - cache_duration_secs):
-            f = open(cache_file)
-            result = f.read()
-            f.close()
-            return result
-    result = func(**kwargs)
-    f = open(cache_file, 'w+')
-    if not isinstance(result, basestring):
-        try:
-            result = json.dumps(result)
-        except Exception, e:
-            result = json_fix(result)
-            result = json.dumps(result)
-    f.write(result)
-    f.close()
-    clean_cache()
-    return result
+    key = func.__name__ + str(kwargs)
+    return get_cache().get_or_compute(key, cache_duration_secs, lambda: func(**kwargs))
 
 
-def run(cmd, cache_duration_secs=0, log_error=False, retries=0, sleep=2, backoff=1.4):
+def run(cmd, cache_duration_secs=0, log_error=False, retries=0, sleep=2, backoff=1.4, timeout=RUN_TIMEOUT_SECS):
+    """
+    Run the given shell command and return its stdout. Raises CalledProcessError if the command fails,
+    or TimeoutExpired if it does not finish within timeout seconds (in which case it is killed). Failed
+    commands are retried up to the given number of retries, sleeping sleep * backoff^n secs in between.
+    """
     def do_run(cmd):
-        try:
-            mutex_popen.acquire()
-            # process = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-            process = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            mutex_popen.release()
-            output = ''
-            for line in iter(process.stdout.readline, ''):
-                output += line
-            out, err = process.communicate()
-            if process.returncode != 0:
-                raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
-            return output
-        except subprocess.CalledProcessError, e:
-            if log_error:
-                LOG.error("%s" % e.output)
-            if retries > 0:
+        delay = sleep
+        for attempt in range(0, retries + 1):
+            try:
+                return execute(cmd, timeout=timeout)
+            except subprocess.SubprocessError, e:
+                if log_error:
+                    LOG.error("%s" % e.output)
+                if attempt >= retries:
+                    raise e
                 LOG.info("INFO: Re-running command '%s'" % cmd)
-                time.sleep(sleep)
-                return run(cmd, cache_duration_secs, log_error, retries - 1, sleep * backoff, backoff)
-            raise e
+                time.sleep(delay)
+                delay *= backoff
     cmd = inject_aws_endpoint(cmd)
     kwargs = {'cmd': cmd}
     return run_cached(do_run, cache_duration_secs=cache_duration_secs, **kwargs)
 
 
+def execute(cmd, timeout=RUN_TIMEOUT_SECS):
+    # limit the number of concurrent processes, but do not serialize process creation
+    with PROCESS_SEMAPHORE:
+        # run the command in a new process group, to be able to kill its child processes on timeout
+        process = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+            start_new_session=True)
+        try:
+            output, err = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired, e:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError, e:
+                # process has terminated in the meantime
+                pass
+            output, err = process.communicate()
+            raise subprocess.TimeoutExpired(cmd, timeout, output=output)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=output)
+    return output
+
+
+def get_http_session(host):
+    mutex_http.acquire()
+    try:
+        session = HTTP_SESSIONS.get(host)
+        if not session:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            HTTP_SESSIONS[host] = session
+        return session
+    finally:
+        mutex_http.release()
+
+
+def http_get(url, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT):
+    """
+    Perform an HTTP GET request using a pooled keep-alive session for the target
+    host, and return the response body. Raises an exception for non-2xx responses.
+    """
+    host = urlparse.urlparse(url).netloc
+    session = get_http_session(host)
+    response = session.get(url, timeout=(connect_timeout, read_timeout))
+    response.raise_for_status()
+    return response.content
+
+
+def http_get_json(url, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT):
+    return json.loads(http_get(url, connect_timeout=connect_timeout, read_timeout=read_timeout))
+
+
 def md5(string):
     import hashlib
     m = hashlib.md5()
@@ -305,33 +434,183 @@ def apply_2dim(array, function):
     return array
 
 
-def parallelize(array_or_dict, func):
-    class MyThread (threading.Thread):
-        def __init__(self, item, key=None):
-            threading.Thread.__init__(self)
-            self.item = item
-            self.key = key
+class PoolTask(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.claimed = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def claim(self):
+        with self.lock:
+            if self.claimed:
+                return False
+            self.claimed = True
+            self.start_time = time.time()
+            return True
 
-        def run(self):
-            if self.key:
-                func(self.key, self.item)
-            else:
-                func(self.item)
-    threads = []
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            LOG.debug('Task %s%s failed: %s' % (self.func, self.args, traceback.format_exc()))
+            self.error = e
+        finally:
+            self.done.set()
+
+    def get(self, timeout=None):
+        """
+        Wait for the task to finish and return its result, or re-raise its exception. The
+        timeout (in seconds) is counted from the time the task started running, i.e., time
+        spent waiting in the queue is not considered. Raises TaskTimeoutException on timeout.
+        """
+        while not self.done.is_set():
+            if timeout is None:
+                self.done.wait()
+                break
+            remaining = timeout
+            if self.start_time is not None:
+                remaining = self.start_time + timeout - time.time()
+            if remaining <= 0:
+                raise TaskTimeoutException('Task %s%s timed out after %s seconds' % (self.func, self.args, timeout))
+            self.done.wait(remaining)
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class WorkerPool(object):
+    """
+    Pool with a bounded number of worker threads, shared by all fan-out operations of
+    the process (see parallelize(..)). Worker threads are started on demand.
+    """
+
+    def __init__(self, max_workers=WORKER_POOL_SIZE):
+        self.max_workers = max_workers
+        self.queue = Queue.Queue()
+        self.workers = set()
+        self.idle_workers = 0
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.stats = {'running': 0, 'completed': 0, 'failed': 0, 'timeouts': 0}
+
+    def submit(self, func, *args):
+        task = PoolTask(func, args)
+        self.queue.put(task)
+        with self.lock:
+            if self.idle_workers < self.queue.qsize() and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._run_worker, name='pool-worker')
+                worker.daemon = True
+                self.workers.add(worker)
+                worker.start()
+        return task
+
+    def set_max_workers(self, max_workers):
+        self.max_workers = max(1, max_workers)
+
+    def is_worker_thread(self):
+        return getattr(self.local, 'is_worker', False)
+
+    def run_task(self, task):
+        if not task.claim():
+            return
+        with self.lock:
+            self.stats['running'] += 1
+        task.run()
+        with self.lock:
+            self.stats['running'] -= 1
+            self.stats['completed' if not task.error else 'failed'] += 1
+
+    def wait_all(self, tasks, timeout=None, raise_errors=False):
+        """
+        Wait for all given tasks and return their results (None for tasks which failed or timed out).
+        If raise_errors is set, the first error is raised after all other tasks have been waited for,
+        otherwise errors are logged. Note that tasks which time out are not interrupted, i.e., they
+        keep running (and keep occupying a worker thread) until they finish by themselves.
+        """
+        if self.is_worker_thread():
+            # avoid deadlocks on nested fan-outs: run tasks which have not been
+            # picked up by another worker yet directly in the current worker thread
+            for task in tasks:
+                self.run_task(task)
+        results = []
+        error = None
+        for task in tasks:
+            try:
+                results.append(task.get(timeout))
+            except TaskTimeoutException, e:
+                with self.lock:
+                    self.stats['timeouts'] += 1
+                error = error or e
+                results.append(None)
+                if not raise_errors:
+                    LOG.warning('%s' % e)
+            except Exception, e:
+                error = error or e
+                results.append(None)
+                if not raise_errors:
+                    LOG.warning('Task %s%s failed: %s' % (task.func, task.args, e))
+        if error and raise_errors:
+            raise error
+        return results
+
+    def get_stats(self):
+        with self.lock:
+            result = dict(self.stats)
+            result['queued'] = self.queue.qsize()
+            result['workers'] = len(self.workers)
+            result['max_workers'] = self.max_workers
+            return result
+
+    def _run_worker(self):
+        self.local.is_worker = True
+        try:
+            while True:
+                with self.lock:
+                    if len(self.workers) > self.max_workers:
+                        # pool has been shrunk, stop this worker
+                        self.workers.discard(threading.current_thread())
+                        return
+                    self.idle_workers += 1
+                task = self.queue.get()
+                with self.lock:
+                    self.idle_workers -= 1
+                self.run_task(task)
+        except Exception, e:
+            LOG.warning('Worker thread failed: %s' % traceback.format_exc())
+            with self.lock:
+                self.workers.discard(threading.current_thread())
+
+
+def get_worker_pool():
+    global WORKER_POOL
+    if not WORKER_POOL:
+        with mutex_pool:
+            if not WORKER_POOL:
+                WORKER_POOL = WorkerPool()
+    return WORKER_POOL
+
+
+def parallelize(array_or_dict, func, timeout=None, raise_errors=False):
+    """
+    Call func for each item of the given list (or with key and item of the given dict)
+    in the shared worker pool, and wait until all calls have finished. Returns the results
+    in the order of the given items, with None for calls which failed or timed out. If
+    raise_errors is set, the first exception raised by any of the calls is propagated to
+    the caller instead. Calls which time out keep running in the background (see wait_all).
+    """
+    pool = get_worker_pool()
     if isinstance(array_or_dict, list):
-        for item in array_or_dict:
-            t = MyThread(item)
-            t.start()
-            threads.append(t)
+        tasks = [pool.submit(func, item) for item in array_or_dict]
     elif isinstance(array_or_dict, dict):
-        for key, item in array_or_dict.iteritems():
-            t = MyThread(item, key)
-            t.start()
-            threads.append(t)
+        tasks = [pool.submit(func, key, item) for key, item in array_or_dict.iteritems()]
     else:
         raise Exception("Expected either array or dict")
-    for t in threads:
-        t.join()
+    return pool.wait_all(tasks, timeout=timeout, raise_errors=raise_errors)
 
 
 def get_start_and_end(diff_secs, format="%m/%d/%Y %H:%M", escape=True):
@@ -346,9 +625,20 @@ def get_start_and_end(diff_secs, format="%m/%d/%Y %H:%M", escape=True):
     return [start_time, end_time]
 
 
+def get_presto_connection(hostname, port=8081):
+    """
+    Get a Presto connection which sends all requests through the pooled
+    keep-alive HTTP session of the given coordinator host and port (the
+    requests_session and requests_kwargs arguments require PyHive 0.6.1).
+    """
+    session = get_http_session('%s:%s' % (hostname, port))
+    return pyhive.presto.connect(hostname, port, poll_interval=PRESTO_POLL_INTERVAL, requests_session=session,
+        requests_kwargs={'timeout': (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)})
+
+
 def run_presto_query(presto_sql, hostname, port=8081):
     if presto_sql != "" and presto_sql is not None:
-        cursor = pyhive.presto.connect(hostname, port).cursor()
+        cursor = get_presto_connection(hostname, port).cursor()
         cursor.execute(presto_sql)
     else:
         raise Exception("Invalid Presto query: '%s'" % presto_sql)
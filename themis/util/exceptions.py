@@ -2,3 +2,8 @@
 class ConnectivityException(Exception):
     def __init__(self, message=None):
         super(Exception, self).__init__(message)
+
+
+class TaskTimeoutException(Exception):
+    def __init__(self, message=None):
+        super(Exception, self).__init__(message)
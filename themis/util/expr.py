@@ -30,6 +30,10 @@ class NodesInfo:
         self.total = AggregateStatsExpr(nodes['sum'])
         self.min = AggregateStatsExpr(nodes['min'])
         self.max = AggregateStatsExpr(nodes['max'])
+        self.stddev = AggregateStatsExpr(nodes.get('stddev', {}))
+        self.p50 = AggregateStatsExpr(nodes.get('p50', {}))
+        self.p90 = AggregateStatsExpr(nodes.get('p90', {}))
+        self.p99 = AggregateStatsExpr(nodes.get('p99', {}))
 
 
 class CountStatsExpr:
@@ -42,6 +46,7 @@ class AggregateStatsExpr:
         self.cpu = info.get('cpu')
         self.mem = info.get('mem')
         self.sysload = info.get('sysload')
+        self.queries = info.get('queries')
 
 
 class TimeBasedScaling:
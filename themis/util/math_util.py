@@ -1,4 +1,6 @@
 # common utility functions for mathematical operations
+import numpy
+from scipy import integrate
 
 
 def vec_mult_items(vec1, vec2):
@@ -40,3 +42,23 @@ def get_stats(values):
     result['max'] = max
     result['avg'] = sum / len(values) if values else float('NaN')
     return result
+
+
+def integrate_curves(curves):
+    """
+    Integrate the given curves (numpy arrays with rows of (value, timestamp)) using
+    Simpson's rule. Curves sharing the same time axis are stacked into a matrix and
+    integrated in a single operation. Returns the list of integrals in input order.
+    """
+    result = [float('NaN')] * len(curves)
+    groups = {}
+    for idx, curve in enumerate(curves):
+        key = curve[:, 1].tostring()
+        groups.setdefault(key, []).append(idx)
+    for indexes in groups.values():
+        x = curves[indexes[0]][:, 1]
+        y = numpy.vstack([curves[idx][:, 0] for idx in indexes])
+        integrated = integrate.simps(y, x, axis=-1)
+        for idx, value in zip(indexes, integrated):
+            result[idx] = float(value)
+    return result
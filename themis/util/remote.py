@@ -1,6 +1,10 @@
-import subprocess
+import subprocess32 as subprocess
 import re
 import os
+import base64
+import hashlib
+import tempfile
+import threading
 from themis.util import common
 from themis.util.common import run, save_file, get_logger
 from themis import config
@@ -8,12 +12,49 @@ from themis.constants import *
 
 KEY_FILE_NAME_PATTERN = '/tmp/ssh.key.%s.pem'
 
+SSH_CONFIGS = ('-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no ' +
+    '-o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=3')
+
+# directory for the control sockets of persistent SSH connections
+SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(), 'themis.ssh')
+
+# seconds after which idle persistent SSH connections are closed
+SSH_IDLE_TIMEOUT_SECS = 5 * 60
+
+# seconds between health checks of persistent SSH connections
+SSH_CHECK_INTERVAL_SECS = 30
+
+# prefix of the output lines which carry the results of batched commands
+SSH_BATCH_RESULT_MARKER = '__themis_result__'
+
+# max. number of commands per batch (the script is limited by the max. length of a command line)
+SSH_BATCH_MAX_COMMANDS = 100
+
+# max. number of commands of a batch which run concurrently on the remote host
+SSH_BATCH_PARALLELISM = 20
+
+# persistent SSH connections, keyed by (user, key, host chain)
+SSH_CONNECTIONS = {}
+SSH_CONNECTIONS_LOCK = threading.Lock()
+
+# SSH key files resolved from the "ssh_keys" config value, keyed by config value
+SSH_KEY_FILES = {}
+
+# global SSH key resolver instance
+SSH_KEY_RESOLVER = None
+mutex_resolver = threading.Lock()
+
 # logger
 LOG = get_logger(__name__)
 
 
 def get_ssh_keys():
-    keys = re.split(r'\s*,\s*', config.get_value(KEY_SSH_KEYS))
+    config_value = config.get_value(KEY_SSH_KEYS)
+    keys = SSH_KEY_FILES.get(config_value)
+    if keys:
+        return list(keys)
+    keys = re.split(r'\s*,\s*', config_value)
+    resolved = True
     for i in range(0, len(keys)):
         key = keys[i]
         if key[0] == '$':
@@ -36,41 +77,297 @@ def get_ssh_keys():
                     run('chmod 600 %s' % key_file)
                 else:
                     LOG.warning('Unable to read SSH key from environment variable: %s' % var_name)
+                    resolved = False
             keys[i] = key_file
+    if resolved:
+        # remember the key files, unless some of them could not be created yet
+        SSH_KEY_FILES[config_value] = keys
+    return list(keys)
+
+
+class SshKeyResolver(object):
+    """
+    Remembers which SSH key has been accepted by each host, so that subsequent connections try
+    that key first instead of going through all configured keys, and keeps success/failure
+    statistics per key. Hosts without a known key are tried with the key of their jump host.
+    """
+
+    def __init__(self):
+        self.host_keys = {}
+        self.stats = {}
+        self.agent_keys = set()
+        self.mutex = threading.Lock()
+
+    def get_keys(self, host_chain, keys):
+        """ Return the given keys, with the preferred key for the last host of host_chain first. """
+        preferred = None
+        for host in reversed(host_chain):
+            preferred = self.host_keys.get(host)
+            if preferred:
+                break
+        if preferred not in keys:
+            return list(keys)
+        return [preferred] + [key for key in keys if key != preferred]
+
+    def report(self, host_chain, key, success):
+        with self.mutex:
+            stats = self.stats.setdefault(key, {'success': 0, 'failure': 0})
+            stats['success' if success else 'failure'] += 1
+            if success:
+                for host in host_chain:
+                    self.host_keys[host] = key
+            elif self.host_keys.get(host_chain[-1]) == key:
+                del self.host_keys[host_chain[-1]]
+
+    def load_keys(self, keys):
+        """ Add the given keys to the SSH agent (if running), each key only once. """
+        with self.mutex:
+            keys = [key for key in keys if key not in self.agent_keys]
+            self.agent_keys.update(keys)
+        if not keys or not os.environ.get('SSH_AUTH_SOCK'):
+            return
+        try:
+            run('ssh-add %s 2>&1 > /dev/null' % ' '.join(keys))
+        except subprocess.CalledProcessError, e:
+            LOG.warning('Unable to add SSH keys to agent: %s' % e.output)
+
+    def get_stats(self):
+        with self.mutex:
+            result = {'hosts': len(self.host_keys), 'keys': {}}
+            for key, stats in self.stats.iteritems():
+                total = stats['success'] + stats['failure']
+                result['keys'][key] = dict(stats, success_rate=float(stats['success']) / total if total else 0)
+        return result
+
+
+def get_key_resolver():
+    global SSH_KEY_RESOLVER
+    if not SSH_KEY_RESOLVER:
+        with mutex_resolver:
+            if not SSH_KEY_RESOLVER:
+                SSH_KEY_RESOLVER = SshKeyResolver()
+    return SSH_KEY_RESOLVER
+
+
+def load_ssh_keys():
+    keys = get_ssh_keys()
+    get_key_resolver().load_keys(keys)
     return keys
 
 
-def run_ssh(cmd, host, user=None, keys=None, via_hosts=[], cache_duration_secs=0):
-    if not keys:
-        keys = get_ssh_keys()
+class SshConnection(object):
+    """
+    Persistent SSH connection to a host, optionally tunnelled through the connection to a jump
+    host, based on an OpenSSH ControlMaster socket. Commands are multiplexed over the existing
+    connection, i.e., they only open a new channel instead of performing a full login.
+    """
 
-    user = '%s@' % user if user else ''
+    def __init__(self, user, host, key, jump=None):
+        self.user = user
+        self.host = host
+        self.key = key
+        self.jump = jump
+        self.target = '%s@%s' % (user, host) if user else host
+        self.socket = os.path.join(SSH_CONTROL_DIR, hashlib.md5(str(self.get_id())).hexdigest()[:16])
+        self.last_used = common.now()
+        self.last_check = 0
+        self.lock = threading.Lock()
 
-    agent_forward = ''
-    forward_addendum = ''
-    ssh_configs = ('-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no ' +
-        '-o PasswordAuthentication=no -o BatchMode=yes -o ConnectTimeout=3')
+    def get_id(self):
+        chain = [self.host]
+        jump = self.jump
+        while jump:
+            chain.insert(0, jump.host)
+            jump = jump.jump
+        return (self.user, self.key, tuple(chain))
 
-    if len(via_hosts) > 0:
-        agent_forward = '-o ForwardAgent=yes'
-        for via_host in list(reversed(via_hosts)):
-            forward_addendum = ('ssh %s %s%s ' % (ssh_configs, user, via_host)) + forward_addendum
+    def get_options(self):
+        options = '%s -i %s -S %s' % (SSH_CONFIGS, self.key, self.socket)
+        if self.jump:
+            options += ' -o "ProxyCommand=ssh -S %s -W %%h:%%p %s"' % (self.jump.socket, self.jump.target)
+        return options
 
-    ssh_cmd_tmpl = 'ssh ' + ssh_configs + ' ' + agent_forward + ' -i %s %s%s "' + forward_addendum + '%s"'
+    def is_alive(self):
+        if not os.path.exists(self.socket):
+            return False
+        try:
+            run('ssh -S %s -O check %s 2> /dev/null' % (self.socket, self.target))
+            return True
+        except subprocess.CalledProcessError, e:
+            return False
 
-    for key in keys:
-        key = key.strip()
-        ssh_cmd = ssh_cmd_tmpl % (key, user, host, cmd)
+    def open(self):
+        if self.jump:
+            self.jump.ensure_open()
+        if not os.path.isdir(SSH_CONTROL_DIR):
+            try:
+                os.makedirs(SSH_CONTROL_DIR, 0700)
+            except OSError, e:
+                # may have been created concurrently
+                pass
+        # the master process runs in the background, hence must not hold on to our stdout/stderr
+        log_file = '%s.log' % self.socket
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+        cmd = 'ssh %s -o ControlMaster=yes -o ControlPersist=%s -E %s -f -N %s > /dev/null 2>&1' % (
+            self.get_options(), SSH_IDLE_TIMEOUT_SECS, log_file, self.target)
+        try:
+            run(cmd)
+        except subprocess.CalledProcessError, e:
+            if os.path.isfile(log_file):
+                with open(log_file) as f:
+                    e.output = f.read()
+            raise e
+        LOG.debug('Opened persistent SSH connection to %s' % (self.get_id(),))
 
-        if len(via_hosts) > 0:
-            run('ssh-add %s 2>&1 > /dev/null' % key)
+    def ensure_open(self):
+        with self.lock:
+            time_now = common.now()
+            if self.last_check < time_now - SSH_CHECK_INTERVAL_SECS or not os.path.exists(self.socket):
+                if not self.is_alive():
+                    self.open()
+                self.last_check = time_now
+            self.last_used = time_now
+        # the tunnel through the jump host is in use as well, hence must not be evicted
+        jump = self.jump
+        while jump:
+            jump.last_used = time_now
+            jump = jump.jump
 
+    def close(self):
+        with self.lock:
+            self.last_check = 0
+            if os.path.exists(self.socket):
+                try:
+                    run('ssh -S %s -O exit %s 2> /dev/null' % (self.socket, self.target))
+                except subprocess.CalledProcessError, e:
+                    pass
+
+    def run(self, cmd, cache_duration_secs=0, forward_agent=False):
+        options = self.get_options()
+        if forward_agent:
+            options += ' -o ForwardAgent=yes'
+        ssh_cmd = 'ssh %s -o ControlMaster=no %s "%s"' % (options, self.target, cmd)
+        return common.run_cached(self.execute, cache_duration_secs=cache_duration_secs, ssh_cmd=ssh_cmd)
+
+    def execute(self, ssh_cmd):
+        self.ensure_open()
         try:
-            out = run(ssh_cmd, cache_duration_secs)
+            return run(ssh_cmd)
+        except subprocess.CalledProcessError, e:
+            # force a health check of the connection before the next command
+            self.last_check = 0
+            raise e
+
+
+def get_connection(user, host, key, via_hosts=[]):
+    """ Get the persistent SSH connection to the last host in [host] + via_hosts, via the preceding hosts. """
+    evict_idle_connections()
+    connection = None
+    with SSH_CONNECTIONS_LOCK:
+        for hop in [host] + list(via_hosts):
+            jump = connection
+            connection = SshConnection(user, hop, key, jump=jump)
+            connection = SSH_CONNECTIONS.setdefault(connection.get_id(), connection)
+    return connection
+
+
+def evict_idle_connections(max_idle_secs=SSH_IDLE_TIMEOUT_SECS):
+    time_now = common.now()
+    with SSH_CONNECTIONS_LOCK:
+        idle = [c for c in SSH_CONNECTIONS.values() if c.last_used < time_now - max_idle_secs]
+        for connection in idle:
+            del SSH_CONNECTIONS[connection.get_id()]
+    for connection in idle:
+        LOG.debug('Closing idle SSH connection to %s' % (connection.get_id(),))
+        connection.close()
+    return idle
+
+
+def run_ssh(cmd, host, user=None, keys=None, via_hosts=[], cache_duration_secs=0, forward_agent=False):
+    if not keys:
+        keys = load_ssh_keys()
+
+    resolver = get_key_resolver()
+    host_chain = [host] + list(via_hosts)
+    for key in resolver.get_keys(host_chain, [key.strip() for key in keys]):
+        connection = get_connection(user, host, key, via_hosts=via_hosts)
+        try:
+            out = connection.run(cmd, cache_duration_secs, forward_agent=forward_agent)
+            resolver.report(host_chain, key, True)
             return out
         except subprocess.CalledProcessError, e:
             # TODO find a more elegant solution for this.
-            if 'Permission denied (publickey)' not in e.output:
+            if 'Permission denied (publickey)' not in (e.output or ''):
                 raise e
+            resolver.report(host_chain, key, False)
 
+    user = '%s@' % user if user else ''
     raise Exception('Cannot run SSH command with any of the provided ssh keys: %s%s %s %s' % (user, host, cmd, keys))
+
+
+def run_ssh_batch(commands, host, user=None, keys=None, cache_duration_secs=0):
+    """
+    Run multiple commands with a single SSH round trip to the given host. The commands are given
+    as a map of IDs to either a command, or a tuple (command, via_host) for commands to be run on
+    another host reachable from the given host (e.g., a node of the cluster). The commands run
+    concurrently on the remote host. Returns a map of IDs to results {'code': .., 'output': ..},
+    where 'output' contains stdout and stderr of the command (code None if the command did not run).
+
+    Unlike run_ssh with via_hosts, which tunnels a separate connection per host through the
+    given host (ProxyCommand), commands for other hosts are run by an ssh client on the given
+    host, so that all hosts are reached with a single round trip. That client authenticates
+    with our SSH agent, which is forwarded for batches with such commands. This requires the
+    SSH keys to be loaded into a local agent (see load_ssh_keys), and it means that any user
+    with root access to the given host can use the agent while the batch is running. Use
+    run_ssh with via_hosts for hosts whose jump host is not trusted.
+    """
+    items = [(key, cmd if isinstance(cmd, tuple) else (cmd, None)) for key, cmd in commands.iteritems()]
+    result = {}
+    for i in range(0, len(items), SSH_BATCH_MAX_COMMANDS):
+        batch = items[i:i + SSH_BATCH_MAX_COMMANDS]
+        script = get_batch_script([cmd for key, cmd in batch], user=user)
+        cmd = 'echo %s | base64 -d | sh' % base64.b64encode(script)
+        # only the hop to other hosts needs our agent, hence do not expose it for local commands
+        forward_agent = any(via_host for key, (command, via_host) in batch)
+        out = run_ssh(cmd, host, user=user, keys=keys, cache_duration_secs=cache_duration_secs,
+            forward_agent=forward_agent)
+        outputs = parse_batch_output(out)
+        for index, (key, cmd) in enumerate(batch):
+            result[key] = outputs.get(index, {'code': None, 'output': ''})
+    return result
+
+
+def get_batch_script(commands, user=None, parallelism=SSH_BATCH_PARALLELISM):
+    """
+    Get a shell script which runs the given (command, via_host) tuples concurrently, and prints
+    the exit code and the base64-encoded output of each command in a separate result line.
+    """
+    user = '%s@' % user if user else ''
+    lines = ['d=$(mktemp -d)']
+    for i, (cmd, via_host) in enumerate(commands):
+        shell = 'sh'
+        if via_host:
+            shell = 'ssh %s -o LogLevel=ERROR %s%s sh' % (SSH_CONFIGS, user, via_host)
+        lines.append('(echo %s | base64 -d | %s > $d/%s 2>&1; echo $? > $d/%s.rc) < /dev/null &' %
+            (base64.b64encode(cmd), shell, i, i))
+        if (i + 1) % parallelism == 0:
+            lines.append('wait')
+    lines.append('wait')
+    # print a placeholder for missing exit codes, to keep the output in the fourth column
+    lines.append(('for i in $(seq 0 %s); do echo "%s $i $(cat $d/$i.rc 2>/dev/null || echo x) ' +
+        '$(base64 -w0 2>/dev/null < $d/$i)"; done') % (len(commands) - 1, SSH_BATCH_RESULT_MARKER))
+    lines.append('rm -rf $d')
+    return '\n'.join(lines)
+
+
+def parse_batch_output(out):
+    result = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or parts[0] != SSH_BATCH_RESULT_MARKER:
+            continue
+        code = int(parts[2]) if common.is_number(parts[2]) else None
+        output = base64.b64decode(parts[3]) if len(parts) > 3 else ''
+        result[int(parts[1])] = {'code': code, 'output': output}
+    return result
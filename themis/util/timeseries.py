@@ -1,4 +1,5 @@
 import pandas
+import numpy
 import time
 import pytz
 from datetime import datetime, timedelta
@@ -49,6 +50,38 @@ class SpotPriceHistoryExtractor(object):
         return time.mktime(datetime.strptime(value['Timestamp'], format).timetuple())
 
 
+class RollingWindow(object):
+    """
+    Buffer of (value, timestamp) datapoints, ordered by timestamp, which only
+    retains the datapoints of the most recent time window.
+    """
+
+    def __init__(self, window_secs):
+        self.window_secs = window_secs
+        self.datapoints = numpy.empty((0, 2))
+
+    def last_timestamp(self):
+        if len(self.datapoints) == 0:
+            return None
+        return self.datapoints[-1, 1]
+
+    def update(self, datapoints, now=None):
+        """
+        Add the given datapoints (numpy array with rows of (value, timestamp)). Buffered
+        datapoints in the time range of the new datapoints are replaced by the new ones.
+        """
+        if len(datapoints) > 0:
+            datapoints = datapoints[datapoints[:, 1].argsort()]
+            older = self.datapoints[self.datapoints[:, 1] < datapoints[0, 1]]
+            self.datapoints = numpy.concatenate((older, datapoints))
+        self.evict(now)
+        return self.datapoints
+
+    def evict(self, now=None):
+        now = time.time() if now is None else now
+        self.datapoints = self.datapoints[self.datapoints[:, 1] >= now - self.window_secs]
+
+
 # TODO use this method in aws_pricing.py
 def get_spot_history_curve(spot_history):
     extractor = SpotPriceHistoryExtractor()